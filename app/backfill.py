@@ -0,0 +1,300 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+import logger as logger
+import processing
+import transcode
+from job_store import job_store
+from metrics import metrics
+from notifier import notifier
+from cover_art import cover_cache
+from scanner import Scanner, parse_globs
+
+log = logger.logger
+
+# Same probe window length as the daemon.
+music_segment_duration = 30000  # milliseconds
+# Folders the daemon creates inside an input tree; never walked.
+SKIP_DIRS = {"unrecognized", "quarantine", ".claims"}
+PROGRESS_INTERVAL = 10  # seconds between progress lines and report saves
+REPORT_FIELDS = ["path", "outcome", "seconds", "stage", "title", "artist",
+                 "destination", "error"]
+# Outcomes that --resume does not redo.
+FINAL_OUTCOMES = {"recognized", "unrecognized"}
+
+
+def walk_library(root, exclude=(), include=None, exclude_globs=()):
+    """
+    Paths of supported audio files below `root`, in name order. Hidden
+    entries, the daemon's own folders, folders in `exclude` and anything
+    matching `exclude_globs` are skipped; `include` globs narrow the files.
+    """
+    globs = list(exclude_globs) + sorted(SKIP_DIRS)
+    for path in exclude:
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+        if not relative.startswith(os.pardir):
+            globs.append(relative.replace(os.sep, "/"))
+    include = include or [f"*{extension}" for extension in processing.SUPPORTED_EXTENSIONS]
+    result = Scanner(root, include=include, exclude=globs).scan()
+    log.info(f"Scanned {root}: {result.describe()}")
+    return sorted(path for path in result.changed
+                  if path.lower().endswith(processing.SUPPORTED_EXTENSIONS))
+
+
+def job_key_for(src, path):
+    """
+    Job key of a library file: its path below `src` without the extension,
+    so equally named files in different folders get separate jobs and a
+    converted file keeps the key of its source.
+    """
+    return "backfill:" + os.path.splitext(os.path.relpath(path, src))[0]
+
+
+def load_report(report_path):
+    """
+    Rows of an earlier report (JSON or CSV), or [] if there is none.
+    """
+    if not os.path.exists(report_path):
+        return []
+    with open(report_path, encoding="utf-8", newline="") as f:
+        if report_path.lower().endswith(".csv"):
+            return list(csv.DictReader(f))
+        return json.load(f).get("files", [])
+
+
+class Report:
+    """
+    Per-file outcomes of a backfill run, starting from `rows` kept from an
+    earlier run. CSV reports get a row appended as each file finishes; JSON
+    reports are rewritten atomically every PROGRESS_INTERVAL, so an
+    interrupted run keeps what it finished.
+    """
+
+    def __init__(self, path, rows=None):
+        self.path = path
+        self.csv = path.lower().endswith(".csv")
+        self.rows = list(rows or [])
+        self.summary = {}
+        self._file = None
+        if self.csv:
+            self._file = open(path, "w", encoding="utf-8", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=REPORT_FIELDS)
+            self._writer.writeheader()
+            self._writer.writerows(self.rows)
+            self._file.flush()
+
+    def add(self, row):
+        self.rows.append(row)
+        if self.csv:
+            self._writer.writerow(row)
+            self._file.flush()
+
+    def save(self):
+        if self.csv:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"summary": self.summary, "files": self.rows}, f,
+                      ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        self.save()
+        if self._file is not None:
+            self._file.close()
+
+
+def _format_eta(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m{seconds % 60:02d}s"
+
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.outcomes = {}
+        self.started = time.monotonic()
+
+    def add(self, outcome):
+        self.done += 1
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def describe(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed * 60 if elapsed else 0.0
+        percent = self.done / self.total * 100 if self.total else 100.0
+        eta = _format_eta((self.total - self.done) / rate * 60) if rate else "?"
+        counts = ", ".join(f"{k}={v}" for k, v in sorted(self.outcomes.items()))
+        return (f"[{self.done}/{self.total}] {percent:.1f}% {rate:.1f} files/min "
+                f"ETA {eta} ({counts or 'starting'})")
+
+
+async def process_one(path, src, dst, shazam, upload):
+    """
+    Run one library file through processing.process_file. Recognized files
+    go to the same relative folder under `dst`, unrecognized and quarantined
+    ones to a folder next to the source. Returns a report row.
+    """
+    folder, file = os.path.split(path)
+    destination = os.path.normpath(os.path.join(dst, os.path.relpath(folder, src)))
+    os.makedirs(destination, exist_ok=True)
+    key = job_key_for(src, path)
+    row = {"path": os.path.relpath(path, src)}
+    start = time.monotonic()
+    try:
+        job = await processing.process_file(file, folder, destination, music_segment_duration,
+                                            shazam, key=key, upload=upload)
+    except Exception as e:
+        log.error(f"Processing failed for {path}: {e}")
+        metrics.inc("files_total", result="error")
+        job_store.fail(key, e)
+        job = job_store.get(key)
+        row.update(outcome="error", error=str(e))
+    else:
+        if job is None:
+            row["outcome"] = "quarantined"
+        else:
+            row["outcome"] = "recognized" if job["matched"] else "unrecognized"
+            row["destination"] = job["current_path"]
+    row["seconds"] = round(time.monotonic() - start, 3)
+    if job is not None:
+        row["stage"] = job["stage"]
+        track_data = job["track_data"] or {}
+        row["title"] = track_data.get("title")
+        row["artist"] = track_data.get("subtitle")
+    return row
+
+
+async def backfill(src, dst, report, jobs=2, shazam=None, dry_run=False, upload=False,
+                   include=None, exclude=()):
+    """
+    Process every supported file below `src` with `jobs` files in flight.
+    Files already in the report (kept by --resume) are skipped, and
+    `include`/`exclude` globs filter the walk. With
+    `dry_run`, only lists what would be processed.
+    """
+    done = {row["path"] for row in report.rows}
+    by_key = {}
+    for path in walk_library(src, exclude=[dst], include=include, exclude_globs=exclude):
+        if os.path.relpath(path, src) not in done:
+            by_key.setdefault(job_key_for(src, path), []).append(path)
+    files = []
+    for paths in by_key.values():
+        # "song.flac" would be transcoded over "song.mp3" in the same folder,
+        # so only the file already in the target format is processed.
+        keep = next((p for p in paths if transcode.output_path(p) == p), paths[0])
+        files.append(keep)
+        for path in paths:
+            if path != keep:
+                log.warning(f"Skipping {path}: {os.path.basename(keep)} has the same name")
+                report.add({"path": os.path.relpath(path, src), "outcome": "skipped",
+                            "error": "duplicate name"})
+    log.info(f"Backfill: {len(files)} file(s) to process in {src}"
+             + (f", {len(done)} already done" if done else ""))
+
+    if dry_run:
+        for path in files:
+            job = job_store.get(job_key_for(src, path))
+            report.add({"path": os.path.relpath(path, src), "outcome": "pending",
+                        "stage": job["stage"] if job else None})
+        report.summary = {"dry_run": True, "files": len(files),
+                          "bytes": sum(os.path.getsize(path) for path in files)}
+        return report.summary
+
+    progress = Progress(len(files))
+    queue = asyncio.Queue()
+    for path in files:
+        queue.put_nowait(path)
+
+    async def worker():
+        while not queue.empty():
+            path = queue.get_nowait()
+            row = await process_one(path, src, dst, shazam, upload)
+            report.add(row)
+            progress.add(row["outcome"])
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            log.info(f"Backfill {progress.describe()}")
+            report.summary = summarize(progress)
+            await asyncio.to_thread(report.save)
+
+    reporter_task = asyncio.create_task(reporter())
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, jobs))))
+    finally:
+        reporter_task.cancel()
+        report.summary = summarize(progress)
+        log.info(f"Backfill finished: {progress.describe()}")
+    return report.summary
+
+
+def summarize(progress):
+    elapsed = time.monotonic() - progress.started
+    return {
+        "files": progress.total,
+        "processed": progress.done,
+        "outcomes": dict(progress.outcomes),
+        "elapsed_seconds": round(elapsed, 1),
+        "files_per_minute": round(progress.done / elapsed * 60, 2) if elapsed else 0.0,
+        "stages": metrics.snapshot()["stages"],
+    }
+
+
+async def run(args, shazam=None):
+    if shazam is None and not args.dry_run:
+        from shazamio import Shazam
+        from throttle import ShazamThrottle, ThrottledShazam
+        shazam = ThrottledShazam(Shazam(), ShazamThrottle())
+    args.src, args.dst = os.path.abspath(args.src), os.path.abspath(args.dst)
+    rows = [row for row in load_report(args.report)
+            if row.get("outcome") in FINAL_OUTCOMES] if args.resume else []
+    report = Report(args.report, rows)
+    if not args.dry_run:
+        notifier.start()
+    try:
+        return await backfill(args.src, args.dst, report, jobs=args.jobs, shazam=shazam,
+                              dry_run=args.dry_run, upload=args.upload,
+                              include=parse_globs(args.include) or None,
+                              exclude=parse_globs(args.exclude))
+    finally:
+        report.close()
+        if not args.dry_run:
+            await notifier.stop()
+            await cover_cache.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run an existing music library through the pipeline once.")
+    parser.add_argument("src", help="library folder, walked recursively")
+    parser.add_argument("dst", help="folder for recognized files (the layout of src is kept)")
+    parser.add_argument("-j", "--jobs", type=int, default=int(os.getenv("WORKER_COUNT", "2")),
+                        help="files processed in parallel (default: WORKER_COUNT)")
+    parser.add_argument("--report", default="backfill_report.json",
+                        help="report file; .csv or .json (default: %(default)s)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="list the files that would be processed without touching them")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip files the existing report lists as recognized or unrecognized")
+    parser.add_argument("--include", default="",
+                        help="comma separated globs of files to process, matched against "
+                             "the name or the path below src (default: all supported files)")
+    parser.add_argument("--exclude", default="",
+                        help="comma separated globs of files or folders to skip")
+    parser.add_argument("--upload", action="store_true",
+                        help="also upload recognized files over SFTP")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.src):
+        parser.error(f"{args.src} is not a directory")
+    summary = asyncio.run(run(args))
+    print(json.dumps({k: v for k, v in summary.items() if k != "stages"}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
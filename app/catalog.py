@@ -0,0 +1,191 @@
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import logger as logger
+
+log = logger.logger
+
+CATALOG_DB = os.getenv("CATALOG_DB", os.path.join(
+    os.path.dirname(__file__), "..", "songs.db"))
+
+
+def fold_text(text):
+    """
+    Lowercase, strip accents and punctuation, collapse whitespace.
+    """
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+def normalize_key(artist, title):
+    """
+    Build the duplicate-detection key: accents folded, case and punctuation
+    removed, whitespace collapsed. "Zdravko Čolić - Zašto ona" and
+    "zdravko colic - zasto ona!" map to the same key.
+    """
+    return f"{fold_text(artist)}\x1f{fold_text(title)}"
+
+
+class SongCatalog:
+    """
+    SQLite catalog of recognized songs with a unique normalized
+    artist+title key, so duplicate detection is a single index lookup.
+    """
+
+    def __init__(self, db_path=CATALOG_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS songs (
+                song_key TEXT PRIMARY KEY,
+                artist TEXT NOT NULL,
+                title TEXT NOT NULL,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 1,
+                source_file TEXT,
+                shazam_key TEXT
+            )""")
+        self._conn.commit()
+
+    def record(self, artist, title, source_file=None, shazam_key=None, seen=None):
+        """
+        Insert a song or bump its hit count and last-seen time.
+        Returns True if the song was not in the catalog before.
+        """
+        seen = seen or time.time()
+        song_key = normalize_key(artist, title)
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO songs (song_key, artist, title, first_seen, last_seen, source_file, shazam_key) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (song_key, artist, title, seen, seen, source_file, shazam_key))
+            is_new = cur.rowcount == 1
+            if not is_new:
+                self._conn.execute(
+                    "UPDATE songs SET hits = hits + 1, last_seen = ?, "
+                    "source_file = COALESCE(?, source_file), shazam_key = COALESCE(?, shazam_key) "
+                    "WHERE song_key = ?",
+                    (seen, source_file, shazam_key, song_key))
+            self._conn.commit()
+        return is_new
+
+    def record_track(self, track_data, source_file=None):
+        """
+        Record a Shazam track_data dict. Returns True if the song is new.
+        """
+        return self.record(track_data.get("subtitle", ""), track_data.get("title", ""),
+                           source_file=source_file and os.path.basename(
+                               source_file),
+                           shazam_key=track_data.get("key"))
+
+    def contains(self, artist, title):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM songs WHERE song_key = ?", (normalize_key(artist, title),)).fetchone()
+        return row is not None
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+
+    def search(self, term=None, limit=None):
+        """
+        Return catalog rows as dicts, optionally filtered by a substring of
+        artist or title, most recently seen first.
+        """
+        query = "SELECT artist, title, first_seen, last_seen, hits, source_file, shazam_key FROM songs"
+        params = []
+        if term:
+            query += " WHERE song_key LIKE ?"
+            params.append(f"%{fold_text(term)}%")
+        query += " ORDER BY last_seen DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            cur = self._conn.execute(query, params)
+            columns = [c[0] for c in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    def import_songs_txt(self, path):
+        """
+        Import an "ARTIST - TITLE" per line songs.txt. Returns the number of
+        new songs added.
+        """
+        added = 0
+        seen = os.path.getmtime(path)
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                artist, _, title = line.partition(" - ")
+                if self.record(artist.strip(), title.strip(), source_file=os.path.basename(path), seen=seen):
+                    added += 1
+        log.info(f"Imported {added} new song(s) from {path}")
+        return added
+
+
+catalog = SongCatalog()
+
+
+def _format_time(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Query and maintain the recognized song catalog.")
+    parser.add_argument("-o", "--output", help="write output to a file instead of stdout")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_import = sub.add_parser("import", help="import a songs.txt file")
+    p_import.add_argument("path")
+    p_search = sub.add_parser("search", help="search by artist or title")
+    p_search.add_argument("term", nargs="?")
+    p_search.add_argument("--limit", type=int, default=50)
+    p_export = sub.add_parser("export", help="export the catalog")
+    p_export.add_argument(
+        "--format", choices=["txt", "csv", "json"], default="txt")
+    sub.add_parser("stats", help="show catalog size")
+    args = parser.parse_args(argv)
+    out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+
+    if args.command == "import":
+        catalog.import_songs_txt(args.path)
+    elif args.command == "search":
+        for row in catalog.search(args.term, args.limit):
+            print(f"{row['artist']} - {row['title']}  (hits={row['hits']}, "
+                  f"last seen {_format_time(row['last_seen'])}, file={row['source_file']})", file=out)
+    elif args.command == "export":
+        rows = catalog.search()
+        if args.format == "json":
+            json.dump(rows, out, ensure_ascii=False, indent=2)
+            print(file=out)
+        elif args.format == "csv":
+            writer = csv.DictWriter(out, fieldnames=list(rows[0].keys()) if rows else [
+                                    "artist", "title"])
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                print(f"{row['artist']} - {row['title']}", file=out)
+    elif args.command == "stats":
+        print(f"{catalog.count()} song(s) in {os.path.abspath(catalog.db_path)}", file=out)
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import socket
+import time
+import logger as logger
+
+log = logger.logger
+
+# Identifies this instance in lease files; must be unique per container.
+node_id = os.getenv("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# A lease not refreshed for this long belongs to a dead node and may be
+# taken over. Heartbeats run every quarter of it. Node clocks are assumed
+# to be NTP-synced to well within this window.
+claim_ttl = float(os.getenv("CLAIM_TTL_SECONDS", "120"))
+
+LEASE_SUFFIX = ".lease"
+
+
+class ClaimManager:
+    """
+    Lease files that let several instances share one input folder.
+
+    A claim is a file "<key>.lease" in `claim_dir`, created with O_EXCL so
+    exactly one node wins it, holding the owner's node id. The owner
+    refreshes its mtime as a heartbeat. A lease whose mtime is older than
+    `ttl` is expired: another node takes it over by atomically renaming it
+    aside (only one rename can succeed) and then creating its own.
+    """
+
+    def __init__(self, claim_dir, node=None, ttl=None):
+        self.claim_dir = claim_dir
+        self.node = node or node_id
+        self.ttl = ttl or claim_ttl
+        self.held = set()
+        os.makedirs(claim_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.claim_dir, key + LEASE_SUFFIX)
+
+    def _create(self, key):
+        try:
+            fd = os.open(self._path(key), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.node)
+        self.held.add(key)
+        return True
+
+    def _owner(self, path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.ttl
+        except FileNotFoundError:
+            return False
+
+    def _break(self, path):
+        """
+        Remove an expired lease. Returns True if this node removed it.
+        """
+        stale = f"{path}.{self.node}.stale"
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return False
+        if time.time() - os.stat(stale).st_mtime <= self.ttl:
+            # Refreshed between the check and the rename: put it back,
+            # unless a new lease was created in the meantime.
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        log.warning(f"Reclaimed expired lease {os.path.basename(path)} from {self._owner(stale)}")
+        os.remove(stale)
+        return True
+
+    def acquire(self, key):
+        """
+        Try to claim `key`. Returns True if this node now holds it.
+        """
+        if key in self.held:
+            return True
+        if self._create(key):
+            return True
+        path = self._path(key)
+        if self._owner(path) == self.node:
+            # Left over from before a restart with the same NODE_ID.
+            self.held.add(key)
+            os.utime(path)
+            return True
+        if self._expired(path) and self._break(path):
+            return self._create(key)
+        return False
+
+    def release(self, key):
+        self.held.discard(key)
+        path = self._path(key)
+        if self._owner(path) == self.node:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def holder(self, key):
+        """
+        Node id holding a live lease on `key`, or None.
+        """
+        path = self._path(key)
+        if self._expired(path):
+            return None
+        return self._owner(path)
+
+    def held_elsewhere(self, key):
+        owner = self.holder(key)
+        return owner is not None and owner != self.node
+
+    def refresh(self):
+        """
+        Heartbeat every held lease; leases lost to another node are dropped.
+        """
+        now = time.time()
+        for key in list(self.held):
+            path = self._path(key)
+            if self._owner(path) != self.node:
+                log.warning(f"Lease on {key} was taken over by another node")
+                self.held.discard(key)
+                continue
+            os.utime(path, (now, now))
+
+    def reclaim_expired(self):
+        """
+        Remove expired leases of dead nodes. Returns the number removed.
+        """
+        removed = 0
+        with os.scandir(self.claim_dir) as it:
+            entries = [entry.path for entry in it if entry.name.endswith(LEASE_SUFFIX)]
+        for path in entries:
+            if self._expired(path) and self._break(path):
+                removed += 1
+        return removed
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.ttl / 4)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except OSError as e:
+                log.error(f"Lease heartbeat failed: {e}")
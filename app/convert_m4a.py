@@ -1,21 +1,20 @@
-import os
-from pydub import AudioSegment
-from logger import logger
+from transcode import transcode, transcode_async
 
 
-def convert_m4a_to_mp3(m4a_file, output_dir=None):
+def convert_m4a_to_mp3(m4a_file, output_dir=None, timeout=None):
     """
     Convert an m4a file to mp3.
     Returns the path to the new mp3 file.
     """
-    if output_dir is None:
-        output_dir = os.path.dirname(m4a_file)
-    base = os.path.splitext(os.path.basename(m4a_file))[0]
-    mp3_file = os.path.join(output_dir, base + ".mp3")
-    logger.debug(f"Converting {m4a_file} -> {mp3_file}")
-    audio = AudioSegment.from_file(m4a_file, format="m4a")
-    audio.export(mp3_file, format="mp3")
-    return mp3_file
+    return transcode(m4a_file, output_dir=output_dir, codec="mp3", timeout=timeout)
+
+
+async def convert_m4a_to_mp3_async(m4a_file, output_dir=None, timeout=None):
+    """
+    Convert an m4a file to mp3 without blocking the event loop (see
+    transcode.transcode_async).
+    """
+    return await transcode_async(m4a_file, output_dir=output_dir, codec="mp3", timeout=timeout)
 
 
 if __name__ == "__main__":
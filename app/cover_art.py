@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import io
+import os
+import aiohttp
+from PIL import Image
+import logger as logger
+
+log = logger.logger
+
+COVER_CACHE_DIR = os.getenv("COVER_CACHE_DIR", os.path.join(
+    os.path.dirname(__file__), "..", "cover_cache"))
+cover_cache_max_bytes = int(
+    float(os.getenv("COVER_CACHE_MAX_MB", "200")) * 1024 * 1024)
+cover_fetch_timeout = float(os.getenv("COVER_FETCH_TIMEOUT_SECONDS", "5"))
+# Covers larger than this (pixels on the longest side) are downscaled once
+# when cached; 0 keeps the original image.
+cover_max_size = int(os.getenv("COVER_MAX_SIZE", "600"))
+cover_jpeg_quality = int(os.getenv("COVER_JPEG_QUALITY", "85"))
+
+
+def shrink_cover(data, max_size=None, quality=None):
+    """
+    Downscale and recompress a cover image to JPEG. Returns the original
+    bytes if the image can't be decoded or resizing is disabled.
+    """
+    max_size = cover_max_size if max_size is None else max_size
+    quality = quality or cover_jpeg_quality
+    if not max_size:
+        return data
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail((max_size, max_size))
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG",
+                                  quality=quality, optimize=True)
+    except Exception as e:
+        log.debug(f"Could not recompress cover image: {e}")
+        return data
+    result = buffer.getvalue()
+    return result if len(result) < len(data) else data
+
+
+class CoverArtCache:
+    """
+    Content-addressed on-disk cache of cover images keyed by their URL.
+
+    Fetches are async with a short timeout, and concurrent requests for the
+    same URL share one download. Entries are evicted least recently used
+    first once the cache grows beyond `max_bytes`.
+    """
+
+    def __init__(self, cache_dir=COVER_CACHE_DIR, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes or cover_cache_max_bytes
+        self._inflight = {}
+        self._session = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".jpg")
+
+    async def get(self, url):
+        """
+        Return the cover bytes for a URL, or None if it can't be fetched.
+        """
+        if not url:
+            return None
+        path = self._path(url)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # mtime doubles as the LRU timestamp.
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            pass
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(url, path))
+            self._inflight[url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, url, path):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=cover_fetch_timeout))
+        log.debug(f"Downloading cover from {url}")
+        try:
+            async with self._session.get(url) as response:
+                if response.status != 200:
+                    log.warning(
+                        f"Failed to download cover from {url}: {response.status}")
+                    return None
+                data = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning(f"Exception downloading cover from {url}: {e}")
+            return None
+        data = await asyncio.to_thread(self._store, path, data)
+        return data
+
+    def _store(self, path, data):
+        data = shrink_cover(data)
+        tmp_path = path + ".part"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.evict()
+        return data
+
+    def evict(self):
+        """
+        Remove least recently used covers until the cache fits max_bytes.
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".jpg"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        if total <= self.max_bytes:
+            return 0
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        log.debug(f"Evicted {removed} cover(s) from cache")
+        return removed
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+cover_cache = CoverArtCache()
@@ -0,0 +1,277 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import logger as logger
+from utils import decode_mono_pcm
+from media_info import media_duration
+
+log = logger.logger
+
+FINGERPRINT_DB = os.getenv("FINGERPRINT_DB", os.path.join(
+    os.path.dirname(__file__), "..", "fingerprints.db"))
+fingerprint_enabled = os.getenv("FINGERPRINT_ENABLED", "true").lower() == "true"
+# Landmarks that must agree on one track and time offset for a local hit.
+min_matches = int(os.getenv("FINGERPRINT_MIN_MATCHES", "20"))
+# Landmarks of newly added tracks are kept in a small side index and merged
+# into the main one once they reach this many (or on the reconcile cycle).
+merge_threshold = int(os.getenv("FINGERPRINT_MERGE_THRESHOLD", "50000"))
+
+SAMPLE_RATE = 8000
+FFT_SIZE = 512
+HOP = 256  # 32 ms per frame
+# Stored tracks are fingerprinted over this many seconds around their
+# middle, queries over a shorter window around the middle of the file, so
+# trimmed or padded copies still overlap the stored region.
+INDEX_SECONDS = 60
+QUERY_SECONDS = 15
+# Peak picking: a peak is the maximum of its neighbourhood (frames x bins)
+# and at most PEAKS_PER_SECOND of the strongest are kept.
+PEAK_FRAMES = 15
+PEAK_BINS = 15
+PEAKS_PER_SECOND = 10
+# Each peak is paired with the next FAN_OUT peaks up to MAX_DT frames later.
+FAN_OUT = 4
+MAX_DT = 63
+# Index entries pack (track id << OFFSET_BITS) | anchor frame into uint32.
+OFFSET_BITS = 11
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+
+
+def _sliding_max(a, size, axis):
+    pad = [(0, 0)] * a.ndim
+    pad[axis] = (size // 2, size // 2)
+    padded = np.pad(a, pad, mode="constant", constant_values=-np.inf)
+    return sliding_window_view(padded, size, axis=axis).max(axis=-1)
+
+
+def spectrogram(samples):
+    """
+    Log-magnitude STFT of float samples, shape (frames, FFT_SIZE // 2 + 1).
+    """
+    if len(samples) < FFT_SIZE:
+        return np.empty((0, FFT_SIZE // 2 + 1), dtype=np.float32)
+    frames = sliding_window_view(samples, FFT_SIZE)[::HOP] * np.hanning(FFT_SIZE)
+    magnitude = np.abs(np.fft.rfft(frames, axis=1))
+    return np.log(magnitude + 1e-6).astype(np.float32)
+
+
+def find_peaks(spec):
+    """
+    Return (frame, bin) arrays of the dominant spectral peaks, time ordered.
+    """
+    if not spec.size:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    local_max = _sliding_max(_sliding_max(spec, PEAK_FRAMES, 0), PEAK_BINS, 1)
+    mask = (spec == local_max) & (spec > spec.mean())
+    frames, bins = np.nonzero(mask)
+    budget = max(1, int(len(spec) * HOP / SAMPLE_RATE * PEAKS_PER_SECOND))
+    if len(frames) > budget:
+        strongest = np.argpartition(spec[frames, bins], -budget)[-budget:]
+        frames, bins = frames[strongest], bins[strongest]
+    order = np.lexsort((bins, frames))
+    return frames[order], bins[order]
+
+
+def landmarks(frames, bins):
+    """
+    Pair each peak with the following ones into 24-bit hashes of
+    (bin1, bin2, frame delta). Returns (hashes, anchor frames) as uint32.
+    """
+    hashes, anchors = [], []
+    for k in range(1, FAN_OUT + 1):
+        if len(frames) <= k:
+            break
+        dt = frames[k:] - frames[:-k]
+        valid = (dt > 0) & (dt <= MAX_DT)
+        f1, f2 = bins[:-k][valid], bins[k:][valid]
+        hashes.append((f1 << 15) | (f2 << 6) | dt[valid])
+        anchors.append(frames[:-k][valid])
+    if not hashes:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+    return (np.concatenate(hashes).astype(np.uint32),
+            np.concatenate(anchors).astype(np.uint32))
+
+
+def fingerprint_pcm(pcm):
+    samples = np.frombuffer(pcm, dtype="<i2").astype(np.float32) / 32768.0
+    return landmarks(*find_peaks(spectrogram(samples)))
+
+
+def fingerprint_file(file_path, seconds):
+    """
+    Fingerprint `seconds` of audio around the middle of the file.
+    """
+    duration = media_duration(file_path) or seconds
+    start = max(0.0, (duration - seconds) / 2)
+    return fingerprint_pcm(decode_mono_pcm(file_path, start, seconds, SAMPLE_RATE))
+
+
+class FingerprintIndex:
+    """
+    Local acoustic fingerprints of every successfully recognized file, used
+    to identify re-encodes and trimmed copies without calling Shazam.
+
+    Each track's landmark hashes and anchor frames are stored in SQLite as
+    packed uint32 blobs. In memory, all of them form one inverted index: a
+    hash-sorted uint32 array with a parallel array of packed (track, frame)
+    entries, so a lookup is a vectorized binary search whose cost grows with
+    the log of the index size. A match needs `min_matches` landmarks that
+    agree on the same track and time offset.
+
+    New tracks go into a small sorted side index that lookups search as
+    well, so adding one does not copy the main arrays; merge() folds the
+    side index in once it holds `merge_threshold` landmarks.
+    """
+
+    def __init__(self, db_path=FINGERPRINT_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                track_id INTEGER PRIMARY KEY,
+                content_hash TEXT UNIQUE NOT NULL,
+                track_data TEXT NOT NULL,
+                hashes BLOB NOT NULL,
+                anchors BLOB NOT NULL,
+                created REAL NOT NULL
+            )""")
+        self._conn.commit()
+        self.hashes = None
+        self.entries = None
+        self.pending_hashes = np.empty(0, dtype=np.uint32)
+        self.pending_entries = np.empty(0, dtype=np.uint32)
+
+    def _load(self):
+        if self.hashes is not None:
+            return
+        hashes, entries = [], []
+        for track_id, blob, anchors in self._conn.execute(
+                "SELECT track_id, hashes, anchors FROM fingerprints"):
+            hashes.append(np.frombuffer(blob, dtype=np.uint32))
+            entries.append((np.uint32(track_id) << OFFSET_BITS)
+                           | np.frombuffer(anchors, dtype=np.uint32))
+        if not hashes:
+            self.hashes = self.entries = np.empty(0, dtype=np.uint32)
+            return
+        # Sorting one combined 64-bit key is several times faster than an
+        # argsort followed by two gathers.
+        combined = (np.concatenate(hashes).astype(np.uint64) << np.uint64(32)) | \
+            np.concatenate(entries).astype(np.uint64)
+        combined.sort()
+        self.hashes = (combined >> np.uint64(32)).astype(np.uint32)
+        self.entries = combined.astype(np.uint32)
+        log.debug(f"Fingerprint index loaded: {len(hashes)} track(s), {len(self.hashes)} landmark(s)")
+
+    def add(self, content_hash, track_data, hashes, anchors):
+        """
+        Store a fingerprint. Returns False if this file is already indexed.
+        """
+        anchors = np.minimum(anchors, OFFSET_MASK).astype(np.uint32)
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO fingerprints (content_hash, track_data, hashes, anchors, created) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (content_hash, json.dumps(track_data), hashes.astype(np.uint32).tobytes(),
+                 anchors.tobytes(), time.time()))
+            self._conn.commit()
+            if cur.rowcount != 1:
+                return False
+            if self.hashes is not None:
+                order = np.argsort(hashes, kind="stable")
+                new_hashes = hashes[order].astype(np.uint32)
+                new_entries = (np.uint32(cur.lastrowid) << OFFSET_BITS) | anchors[order]
+                positions = np.searchsorted(self.pending_hashes, new_hashes)
+                self.pending_hashes = np.insert(self.pending_hashes, positions, new_hashes)
+                self.pending_entries = np.insert(self.pending_entries, positions, new_entries)
+                if len(self.pending_hashes) >= merge_threshold:
+                    self._merge()
+        return True
+
+    def _merge(self):
+        if not len(self.pending_hashes):
+            return 0
+        positions = np.searchsorted(self.hashes, self.pending_hashes)
+        self.hashes = np.insert(self.hashes, positions, self.pending_hashes)
+        self.entries = np.insert(self.entries, positions, self.pending_entries)
+        merged = len(self.pending_hashes)
+        self.pending_hashes = np.empty(0, dtype=np.uint32)
+        self.pending_entries = np.empty(0, dtype=np.uint32)
+        log.debug(f"Merged {merged} new landmark(s) into the fingerprint index")
+        return merged
+
+    def merge(self):
+        """
+        Fold recently added tracks into the main index.
+        Returns the number of landmarks merged.
+        """
+        with self._lock:
+            return self._merge() if self.hashes is not None else 0
+
+    def match(self, hashes, anchors):
+        """
+        Return (track_data, score) of the best confident match, or None.
+        """
+        with self._lock:
+            self._load()
+            indexes = [(self.hashes, self.entries),
+                       (self.pending_hashes, self.pending_entries)]
+        if not len(hashes):
+            return None
+        found, query_anchors = [], []
+        for index_hashes, index_entries in indexes:
+            if not len(index_hashes):
+                continue
+            lo = np.searchsorted(index_hashes, hashes, side="left")
+            hi = np.searchsorted(index_hashes, hashes, side="right")
+            counts = hi - lo
+            total = int(counts.sum())
+            if not total:
+                continue
+            # Flatten every [lo, hi) range into one array of index positions.
+            starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+            found.append(index_entries[np.arange(total) + starts])
+            query_anchors.append(np.repeat(anchors.astype(np.int64), counts))
+        if not found:
+            return None
+        found = np.concatenate(found)
+        tracks = (found >> OFFSET_BITS).astype(np.int64)
+        offsets = (found & OFFSET_MASK).astype(np.int64) - np.concatenate(query_anchors)
+        keys, votes = np.unique(tracks * (4 * OFFSET_MASK) + offsets + 2 * OFFSET_MASK,
+                                return_counts=True)
+        best = np.argmax(votes)
+        score = int(votes[best])
+        best_track = int(keys[best] // (4 * OFFSET_MASK))
+        runner_up = votes[keys // (4 * OFFSET_MASK) != best_track]
+        if score < min_matches or (runner_up.size and score < 2 * runner_up.max()):
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT track_data FROM fingerprints WHERE track_id = ?", (best_track,)).fetchone()
+        return (json.loads(row[0]), score) if row else None
+
+    def lookup_file(self, file_path):
+        """
+        Identify a file from a short window around its middle.
+        Returns (track_data, score) or None.
+        """
+        return self.match(*fingerprint_file(file_path, QUERY_SECONDS))
+
+    def add_file(self, file_path, content_hash, track_data):
+        hashes, anchors = fingerprint_file(file_path, INDEX_SECONDS)
+        if not len(hashes):
+            return False
+        return self.add(content_hash, track_data, hashes, anchors)
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+
+
+fingerprint_index = FingerprintIndex()
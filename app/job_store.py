@@ -0,0 +1,201 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import logger as logger
+
+log = logger.logger
+
+JOB_STORE_DB = os.getenv("JOB_STORE_DB", os.path.join(
+    os.path.dirname(__file__), "..", "jobs.db"))
+# Jobs that left the input folder are kept this long for inspection.
+job_retention_seconds = float(os.getenv("JOB_RETENTION_DAYS", "30")) * 86400
+
+# Pipeline stages in order. A job's stage is the last one it completed.
+# "converted" is only found on jobs from before files were transcoded after
+# recognition ("transcoded") instead of up front.
+STAGES = ["discovered", "converted", "probed",
+          "recognized", "transcoded", "tagged", "moved", "uploaded"]
+
+
+def reached(job, stage):
+    """
+    True if the job has completed `stage` (or a later one).
+    """
+    return STAGES.index(job["stage"]) >= STAGES.index(stage)
+
+
+class JobStore:
+    """
+    Durable per-file pipeline state, keyed like the watcher by file stem.
+
+    Every completed stage is committed before the next one starts, so after
+    a crash or restart a file resumes after its last completed stage instead
+    of being converted or sent to Shazam again. Transitions only move
+    forward; repeating one is a no-op.
+    """
+
+    def __init__(self, db_path=JOB_STORE_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_key TEXT PRIMARY KEY,
+                source_name TEXT NOT NULL,
+                content_hash TEXT,
+                stage TEXT NOT NULL,
+                current_path TEXT,
+                matched INTEGER,
+                track_data TEXT,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage)")
+        self._conn.commit()
+
+    def _row(self, cur):
+        row = cur.fetchone()
+        if row is None:
+            return None
+        job = dict(zip([c[0] for c in cur.description], row))
+        job["track_data"] = json.loads(job["track_data"]) if job["track_data"] else None
+        return job
+
+    def get(self, job_key):
+        with self._lock:
+            return self._row(self._conn.execute(
+                "SELECT * FROM jobs WHERE job_key = ?", (job_key,)))
+
+    def start(self, job_key, source_path, content_hash):
+        """
+        Create (or restart) the job for a newly discovered file.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_key, source_name, content_hash, stage, current_path, "
+                "created, updated) VALUES (?, ?, ?, 'discovered', ?, ?, ?)",
+                (job_key, os.path.basename(source_path), content_hash, source_path, now, now))
+            self._conn.commit()
+        return self.get(job_key)
+
+    def resume(self, job_key):
+        """
+        Count another attempt at an unfinished job and return it.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET attempts = attempts + 1, updated = ? WHERE job_key = ?",
+                (time.time(), job_key))
+            self._conn.commit()
+        return self.get(job_key)
+
+    def advance(self, job_key, stage, current_path=None, matched=None, track_data=None):
+        """
+        Record that `stage` completed. Fields left as None keep their value.
+        Returns the updated job.
+        """
+        rank = STAGES.index(stage)
+        with self._lock:
+            job = self._row(self._conn.execute(
+                "SELECT * FROM jobs WHERE job_key = ?", (job_key,)))
+            if job is None:
+                raise KeyError(job_key)
+            if STAGES.index(job["stage"]) < rank:
+                self._conn.execute(
+                    "UPDATE jobs SET stage = ?, current_path = COALESCE(?, current_path), "
+                    "matched = COALESCE(?, matched), track_data = COALESCE(?, track_data), "
+                    "error = NULL, updated = ? WHERE job_key = ?",
+                    (stage, current_path, None if matched is None else int(bool(matched)),
+                     json.dumps(track_data) if track_data else None, time.time(), job_key))
+                self._conn.commit()
+            log.debug(f"Job {job_key}: {stage}")
+        return self.get(job_key)
+
+    def fail(self, job_key, error):
+        """
+        Keep the job at its last completed stage and note why it stopped.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET error = ?, updated = ? WHERE job_key = ?",
+                (str(error), time.time(), job_key))
+            self._conn.commit()
+
+    def mark_uploaded(self, file_path):
+        """
+        Complete the job whose file was moved to `file_path` (used by the
+        pending-upload retry, which only knows the processed path).
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET stage = 'uploaded', error = NULL, updated = ? "
+                "WHERE current_path = ? AND stage = 'moved'",
+                (time.time(), file_path))
+            self._conn.commit()
+
+    def relocate(self, old_path, new_path):
+        """
+        Follow a finished file that moved again (from staging to the
+        processed folder) without changing its stage.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET current_path = ?, updated = ? WHERE current_path = ?",
+                (new_path, time.time(), old_path))
+            self._conn.commit()
+
+    def discard(self, job_key):
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE job_key = ?", (job_key,))
+            self._conn.commit()
+
+    def unfinished(self):
+        """
+        Jobs whose file is still in the input folder (not yet moved).
+        """
+        active = STAGES[:STAGES.index("moved")]
+        with self._lock:
+            cur = self._conn.execute(
+                f"SELECT job_key FROM jobs WHERE stage IN ({','.join('?' * len(active))}) "
+                "ORDER BY created", active)
+            keys = [row[0] for row in cur.fetchall()]
+        return [self.get(key) for key in keys]
+
+    def failed(self):
+        """
+        Unfinished jobs whose last attempt stopped with an error.
+        """
+        return [job for job in self.unfinished() if job["error"] is not None]
+
+    def counts(self):
+        """
+        Number of jobs per stage.
+        """
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT stage, COUNT(*) FROM jobs GROUP BY stage").fetchall())
+
+    def prune(self):
+        """
+        Forget jobs that left the input folder more than the retention
+        period ago. Returns the number removed.
+        """
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM jobs WHERE stage IN ('moved', 'uploaded') AND updated < ?",
+                (time.time() - job_retention_seconds,))
+            self._conn.commit()
+        if cur.rowcount:
+            log.info(f"Pruned {cur.rowcount} finished job(s)")
+        return cur.rowcount
+
+
+job_store = JobStore()
@@ -1,19 +1,35 @@
 from shazamio import Shazam
 import processing as processing
+import sftp_upload
+import transcode
+import staging
 import logger as logger
 import asyncio
 import sys
 import os
-from notifier import send_slack_notification
+from notifier import send_slack_notification, notifier
+from watcher import FileWatcher, file_key
+from throttle import ShazamThrottle, ThrottledShazam
+from recognition_cache import recognition_cache
+from catalog import catalog
+from matching import matcher
+from fingerprint import fingerprint_index
+from job_store import job_store
+from claims import ClaimManager
+from cover_art import cover_cache
+from metrics import metrics
+from status_server import start_status_server
+from scanner import Scanner, SCAN_MANIFEST_DB
 sys.path.insert(0, os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..')))
 
 log = logger.logger
-shazam = Shazam()
+throttle = ShazamThrottle()
+shazam = ThrottledShazam(Shazam(), throttle)
 
-# Use fixed folder paths from volume mounts (changed processed_folder to a relative path)
-path_to_dir = "/app/to_process"
-processed_folder = "/app/processed_songs"
+# Folder paths from the volume mounts.
+path_to_dir = os.getenv("TO_PROCESS_DIR", "/app/to_process")
+processed_folder = os.getenv("PROCESSED_DIR", "/app/processed_songs")
 
 if not os.path.exists(path_to_dir):
     log.error(
@@ -24,68 +40,217 @@ if not os.path.exists(processed_folder):
         f"Processed directory {processed_folder} does not exist. Creating it.")
     os.makedirs(processed_folder, mode=0o777, exist_ok=True)
 
+# Leases that let several instances share the input folder; each file is
+# processed by the node holding its lease.
+claims = ClaimManager(os.path.join(path_to_dir, ".claims"))
+
 music_segment_duration = 30000  # milliseconds
-check_delay = 1  # seconds
-output_file = "./songs.txt"
-skip_chunk = 2  # 1 - every, 2 - odd ...
+# Plain-text song list used before the catalog; imported once on startup.
+legacy_song_list = "./songs.txt"
 
 sleep_time_minutes = int(os.getenv("SLEEP_TIME_MINUTES", "5"))
 sleep_time_seconds = sleep_time_minutes * 60
 
+# Number of files processed in parallel.
+worker_count = int(os.getenv("WORKER_COUNT", "2"))
 
-async def main():
-    log.info("Starting Music Watchdog")
-    send_slack_notification("Music Watchdog is running")
+# Incremental scan of the input folder; only its top level is processed,
+# like the watcher.
+scanner = Scanner(path_to_dir, manifest_db=SCAN_MANIFEST_DB, recursive=False)
 
-    while True:
-        # Check for files in the input folder.
-        files = [f for f in os.listdir(path_to_dir)
-                 if os.path.isfile(os.path.join(path_to_dir, f))]
-        file_count = len(files)
-        log.info(f"Found {file_count} files in {path_to_dir}")
-
-        if file_count > 0:
-            for file in files:
-                log.info(f"Processing file: {file}")
-                await processing.process_file(file, path_to_dir, processed_folder,
-                                              music_segment_duration, skip_chunk,
-                                              check_delay, output_file, shazam)
+
+def count_files(folder):
+    """
+    Number of regular files directly in `folder` (0 if it doesn't exist).
+    """
+    try:
+        with os.scandir(folder) as it:
+            return sum(1 for entry in it if entry.is_file())
+    except FileNotFoundError:
+        return 0
+
+
+def resume_jobs(watcher):
+    """
+    Clean up temp files left by an interrupted run, hand files it left in
+    staging to the pending uploads and requeue every job that had not left
+    the input folder yet.
+    """
+    processing.cleanup_artifacts(path_to_dir, in_use=claims.held_elsewhere)
+    for staged_path, processed_path in staging.recover(path_to_dir, processed_folder,
+                                                       in_use=claims.held_elsewhere):
+        # Uploaded by upload_pending from the processed folder.
+        job_store.relocate(staged_path, processed_path)
+        log.info(f"Unstaged {os.path.basename(staged_path)} left by an interrupted run")
+    jobs = job_store.unfinished()
+    for job in jobs:
+        path = job["current_path"]
+        transcoded = transcode.output_path(path)
+        if not os.path.exists(path) and os.path.exists(transcoded):
+            # Stopped after the transcode replaced the source.
+            path = transcoded
+        if os.path.exists(path):
+            watcher.submit(path)
         else:
+            log.warning(f"Dropping job {job['job_key']}: {path} no longer exists")
+            job_store.discard(job["job_key"])
+    if jobs:
+        log.info(f"Resuming {len(jobs)} unfinished job(s)")
+
+
+def upload_pending():
+    """
+    Retry the SFTP upload for files left in the processed folder, as one
+    parallel batch over the shared SFTP connection.
+    """
+    # scandir reports the entry type with the listing, so this is one
+    # directory read instead of a stat() per file.
+    with os.scandir(processed_folder) as it:
+        processed_files = [entry.path for entry in it
+                           if entry.is_file() and not entry.name.startswith(".")]
+    if not processed_files:
+        log.info("No processed files pending upload.")
+        return
+    log.info(f"Found {len(processed_files)} processed file(s) pending upload")
+    if not sftp_upload.sftp_configured():
+        log.error("SFTP credentials not fully set. Skipping SFTP upload.")
+        return
+    file_paths = [path for path in processed_files
+                  if claims.acquire(processing.upload_claim_key(path))]
+    if not file_paths:
+        log.info("Pending uploads are being handled by another instance.")
+        return
+    try:
+        results = sftp_upload.upload_files_sftp(file_paths)
+    finally:
+        for path in file_paths:
+            claims.release(processing.upload_claim_key(path))
+    for file_path, upload_success in results.items():
+        if upload_success:
+            job_store.mark_uploaded(file_path)
+        else:
+            log.error(
+                f"SFTP upload failed for {file_path}. File remains in processed folder.")
+
+
+def scan_input():
+    with metrics.timed("scan"):
+        return scanner.scan()
+
+
+async def reconcile(watcher):
+    """
+    Safety-net scan: every SLEEP_TIME_MINUTES, hand new or changed files in
+    the input folder to the watcher (missed events, files present at startup)
+    and retry pending uploads when there is nothing new to process. Files
+    whose job stopped with an error are handed over again every cycle even
+    if they did not change; other unchanged files are only picked up again
+    on the scanner's full scans, the first of which runs at startup.
+    """
+    while True:
+        result = await asyncio.to_thread(scan_input)
+        log.info(f"Scanned {path_to_dir}: {result.describe()}")
+        files = scanner.present() if result.full else result.changed
+        for path in files:
+            watcher.submit(path)
+        for job in job_store.failed():
+            if os.path.isfile(job["current_path"]):
+                log.info(f"Retrying {job['source_name']} after error: {job['error']}")
+                watcher.submit(job["current_path"])
+
+        if not result.files:
             log.info("No new files to process.")
             # Check if there are files in the processed folder pending upload.
-            processed_files = [f for f in os.listdir(processed_folder)
-                               if os.path.isfile(os.path.join(processed_folder, f))]
-            if processed_files:
-                for file in processed_files:
-                    log.info(f"Found processed file pending upload: {file}")
-                    file_path = os.path.join(processed_folder, file)
-                    # Retrieve SFTP credentials from environment.
-                    sftp_username = os.environ.get("SFTP_USERNAME")
-                    sftp_host = os.environ.get("SFTP_HOST")
-                    sftp_password = os.environ.get("SFTP_PASSWORD")
-                    sftp_port = int(os.environ.get("SFTP_PORT", 2022))
-                    sftp_remote_dir = os.environ.get(
-                        "SFTP_REMOTE_DIR", "/upload")
-                    if sftp_username and sftp_host and sftp_password:
-                        upload_success = processing.upload_file_sftp(
-                            file_path, sftp_username, sftp_host, sftp_password, sftp_port, sftp_remote_dir)
-                        if not upload_success:
-                            log.error(
-                                f"SFTP upload failed for {file_path}. File remains in processed folder.")
-                    else:
-                        log.error(
-                            "SFTP credentials not fully set. Skipping SFTP upload.")
-            else:
-                log.info("No processed files pending upload.")
-
-        log.info(f"Sleeping for {sleep_time_minutes} minutes.")
-        remaining_minutes = sleep_time_minutes
-        while remaining_minutes > 0:
-            log.info(f"Sleeping for {remaining_minutes} minute(s)")
-            await asyncio.sleep(60)
-            remaining_minutes -= 1
-
-asyncio.run(main())
-
-
-asyncio.run(main())
+            await asyncio.to_thread(upload_pending)
+
+        log.info(
+            f"Workers: {worker_count}, queued: {watcher.queue.qsize()}, Shazam: {throttle.describe()}")
+        hits, misses = recognition_cache.stats(reset=True)
+        log.info(
+            f"Recognition cache this cycle: {hits} hit(s), {misses} miss(es)")
+        recognition_cache.evict()
+        job_store.prune()
+        await asyncio.to_thread(fingerprint_index.merge)
+        reclaimed = await asyncio.to_thread(claims.reclaim_expired)
+        if reclaimed:
+            log.info(f"Reclaimed {reclaimed} lease(s) left by stopped instances")
+        log.info(f"Next reconciliation scan in {sleep_time_minutes} minute(s).")
+        await asyncio.sleep(sleep_time_seconds)
+
+
+async def worker(watcher, worker_id):
+    """
+    Take stable files off the watcher queue and run them through the pipeline.
+    """
+    while True:
+        file_path = await watcher.queue.get()
+        file = os.path.basename(file_path)
+        key = file_key(file_path)
+        claimed = False
+        try:
+            claimed = await asyncio.to_thread(claims.acquire, key)
+            if not claimed:
+                log.debug(f"{file} is claimed by another instance, skipping")
+                continue
+            # Checked after claiming: another instance may have just finished it.
+            if not os.path.isfile(file_path):
+                log.debug(f"File no longer present, skipping: {file}")
+                continue
+            log.info(f"[worker {worker_id}] Processing file: {file}")
+            await processing.process_file(file, path_to_dir, processed_folder,
+                                          music_segment_duration, shazam, claims=claims)
+        except Exception as e:
+            log.error(f"Processing failed for {file}: {e}")
+            metrics.inc("files_total", result="error")
+            job_store.fail(key, e)
+        finally:
+            if claimed:
+                await asyncio.to_thread(claims.release, key)
+            watcher.done(file_path)
+            watcher.queue.task_done()
+
+
+async def main():
+    log.info(f"Starting Music Watchdog (node {claims.node})")
+    notifier.start()
+    if catalog.count() == 0 and os.path.exists(legacy_song_list):
+        catalog.import_songs_txt(legacy_song_list)
+    # Seed the match index now rather than on the first is_match call.
+    await asyncio.to_thread(matcher.index.load_catalog)
+    send_slack_notification("Music Watchdog is running")
+
+    watcher = FileWatcher(path_to_dir, asyncio.get_running_loop())
+    watcher.start()
+    metrics.register_gauge("queue_depth", watcher.queue.qsize)
+    metrics.register_gauge("input_backlog", lambda: count_files(path_to_dir))
+    metrics.register_gauge("unrecognized_backlog",
+                           lambda: count_files(os.path.join(path_to_dir, "unrecognized")))
+    metrics.register_gauge("pending_uploads", lambda: count_files(processed_folder))
+    metrics.register_info("shazam", throttle.describe)
+    metrics.register_info("jobs", job_store.counts)
+    metrics.register_info("scan", scanner.describe)
+    status_server = await start_status_server()
+    resume_jobs(watcher)
+    reconcile_task = asyncio.create_task(reconcile(watcher))
+    heartbeat_task = asyncio.create_task(claims.heartbeat())
+
+    workers = [asyncio.create_task(worker(watcher, i))
+               for i in range(worker_count)]
+    log.info(f"Started {worker_count} worker(s). Shazam: {throttle.describe()}")
+
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        reconcile_task.cancel()
+        heartbeat_task.cancel()
+        for task in workers:
+            task.cancel()
+        watcher.stop()
+        if status_server is not None:
+            status_server.close()
+        await notifier.stop()
+        await cover_cache.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,253 @@
+import difflib
+import os
+import re
+import threading
+from functools import lru_cache
+import mutagen
+import logger as logger
+from catalog import catalog, fold_text
+
+log = logger.logger
+
+# Tokens shared by more entries than this are too common to narrow down
+# candidates (e.g. "the", "love") and are skipped in index lookups.
+MAX_POSTINGS = 2000
+
+TRACK_NUMBER = re.compile(r"^\s*(?:\d{1,3}|[a-d]\d{1,2})(?:\s*[-._)\]]\s*|\s+)")
+FEATURING = re.compile(r"\s*[\(\[]?\b(?:feat|ft|featuring)\b\.?.*$", re.IGNORECASE)
+BRACKETED_NOISE = re.compile(
+    r"[\(\[][^\)\]]*\b(?:official|video|audio|lyrics?|hd|hq|remaster(?:ed)?|explicit|clean|visuali[sz]er)\b[^\)\]]*[\)\]]",
+    re.IGNORECASE)
+
+
+@lru_cache(maxsize=200000)
+def normalize(text):
+    """
+    Normalize an artist or title for comparison: "feat." credits, noise in
+    brackets ("(Official Video)") and a leading track number are removed,
+    then accents, case and punctuation are folded.
+    """
+    text = TRACK_NUMBER.sub("", text or "")
+    text = BRACKETED_NOISE.sub(" ", text)
+    text = FEATURING.sub("", text)
+    return fold_text(text)
+
+
+@lru_cache(maxsize=200000)
+def tokens(text):
+    return tuple(normalize(text).split())
+
+
+@lru_cache(maxsize=200000)
+def trigrams(text):
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def similarity(a, b):
+    """
+    Similarity of two normalized strings in [0, 1].
+    """
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def token_coverage(needle, haystack):
+    """
+    Fraction of `needle` tokens found in `haystack` tokens, allowing small
+    spelling differences per token.
+    """
+    if not needle:
+        return 0.0
+    found = 0.0
+    for token in needle:
+        if token in haystack:
+            found += 1
+            continue
+        grams = trigrams(token)
+        best = max((2 * len(grams & trigrams(other)) / (len(grams) + len(trigrams(other)))
+                    for other in haystack), default=0.0)
+        found += best if best >= 0.6 else 0.0
+    return found / len(needle)
+
+
+def parse_filename(file_name):
+    """
+    Split a file name into (artist, title). Names that are not in
+    "ARTIST - TITLE" form return (None, whole name).
+    """
+    base = os.path.splitext(os.path.basename(file_name))[0]
+    base = TRACK_NUMBER.sub("", base.replace("_", " "))
+    if "-" in base:
+        artist, title = base.split("-", 1)
+        if artist.strip() and title.strip():
+            return artist.strip(), title.strip()
+    return None, base.strip()
+
+
+def read_tags(file_path):
+    """
+    Return the (artist, title) already tagged on the file, or None.
+    """
+    try:
+        audio = mutagen.File(file_path, easy=True)
+    except Exception:
+        return None
+    if not audio or not audio.tags:
+        return None
+    artist = (audio.tags.get("artist") or [""])[0]
+    title = (audio.tags.get("title") or [""])[0]
+    if artist and title:
+        return artist, title
+    return None
+
+
+class MatchIndex:
+    """
+    In-memory n-gram index of known songs (seeded from the catalog) used to
+    resolve file names that don't carry both artist and title.
+
+    Songs are indexed by word tokens and, for misspelled names, by character
+    trigrams. Lookups only touch the posting lists of the query's tokens
+    (trigrams only when no token matches), and overly common keys are
+    skipped, so the cost depends on how many songs share those keys rather
+    than on catalog size.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.postings = {}
+        self.gram_postings = {}
+        self._keys = set()
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def add(self, artist, title):
+        artist_norm, title_norm = normalize(artist), normalize(title)
+        key = (artist_norm, title_norm)
+        with self._lock:
+            if key in self._keys:
+                return
+            self._keys.add(key)
+            entry_id = len(self.entries)
+            self.entries.append(key)
+            for token in set(artist_norm.split()) | set(title_norm.split()):
+                self.postings.setdefault(token, []).append(entry_id)
+            for gram in trigrams(title_norm):
+                self.gram_postings.setdefault(gram, []).append(entry_id)
+
+    def load_catalog(self):
+        """
+        Seed the index from the catalog once. Blocks; called at startup off
+        the event loop, and by lookups that run before it finished.
+        """
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            for row in catalog.search():
+                self.add(row["artist"], row["title"])
+            self._loaded = True
+        log.debug(f"Match index loaded with {len(self.entries)} song(s)")
+
+    def _lookup(self, keys, postings):
+        hits = {}
+        for key in keys:
+            posting = postings.get(key, ())
+            if len(posting) > MAX_POSTINGS:
+                continue
+            for entry_id in posting:
+                hits[entry_id] = hits.get(entry_id, 0) + 1
+        return hits
+
+    def candidates(self, text, limit=5):
+        """
+        Return up to `limit` (score, artist, title) entries whose title is
+        best covered by a free-form string such as a file name.
+        """
+        self.load_catalog()
+        query = set(tokens(text))
+        hits = self._lookup(query, self.postings)
+        if not hits:
+            hits = self._lookup(trigrams(" ".join(sorted(query))), self.gram_postings)
+        best = sorted(hits, key=hits.get, reverse=True)[:limit * 4]
+        scored = []
+        for entry_id in best:
+            artist, title = self.entries[entry_id]
+            scored.append((token_coverage(title.split(), query), artist, title))
+        scored.sort(reverse=True)
+        return scored[:limit]
+
+
+def pair_score(recognized, candidate):
+    """
+    Score (artist, title) pairs against each other; the weaker of the two
+    similarities decides.
+    """
+    return min(similarity(normalize(recognized[0]), normalize(candidate[0])),
+               similarity(normalize(recognized[1]), normalize(candidate[1])))
+
+
+class Matcher:
+    """
+    Decide whether a Shazam result belongs to a local file, trying in order:
+    the "ARTIST - TITLE" file name (either order), tags already on the file,
+    artist and title contained in a free-form file name, and the best known
+    catalog song for the file name. With `use_tags=False` the file's tags
+    are skipped, for candidates that were read from those same tags.
+    """
+
+    def __init__(self, index=None):
+        self.index = index or MatchIndex()
+
+    def add(self, artist, title):
+        self.index.add(artist, title)
+
+    def is_match(self, recognized_artist, recognized_title, file_name, threshold=0.7,
+                 use_tags=True):
+        recognized = (recognized_artist, recognized_title)
+        file_artist, file_title = parse_filename(file_name)
+
+        if file_artist:
+            score = max(pair_score(recognized, (file_artist, file_title)),
+                        pair_score(recognized, (file_title, file_artist)))
+            log.debug(
+                f"Comparing with file name: score={score:.2f}")
+            if score >= threshold:
+                return True
+
+        tags = read_tags(file_name) if use_tags and os.path.exists(file_name) else None
+        if tags:
+            score = pair_score(recognized, tags)
+            log.debug(f"Comparing with existing tags {tags}: score={score:.2f}")
+            if score >= threshold:
+                return True
+
+        name = f"{file_artist} {file_title}" if file_artist else file_title
+        name_tokens = set(tokens(name))
+        title_cov = token_coverage(tokens(recognized_title), name_tokens)
+        artist_cov = token_coverage(tokens(recognized_artist), name_tokens)
+        log.debug(
+            f"Token coverage in file name: title={title_cov:.2f}, artist={artist_cov:.2f}")
+        if title_cov >= threshold and artist_cov >= threshold:
+            return True
+
+        if title_cov >= threshold:
+            # Title-only file name: accept if the catalog knows this title
+            # by the recognized artist.
+            for score, artist, title in self.index.candidates(name):
+                if score < threshold:
+                    break
+                if pair_score(recognized, (artist, title)) >= threshold:
+                    log.debug(
+                        f"Matched catalog candidate {artist} - {title} (score={score:.2f})")
+                    return True
+        return False
+
+
+matcher = Matcher()
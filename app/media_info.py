@@ -0,0 +1,199 @@
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+import mutagen
+import logger as logger
+
+log = logger.logger
+
+MEDIA_INFO_DB = os.getenv("MEDIA_INFO_DB", os.path.join(
+    os.path.dirname(__file__), "..", "media_info.db"))
+max_entries = int(os.getenv("MEDIA_INFO_MAX_ENTRIES", "100000"))
+# Shorter files are quarantined instead of being sent to Shazam.
+min_duration = float(os.getenv("MIN_DURATION_SECONDS", "30"))
+
+# Codecs each extension may hold (prefixes of ffprobe's codec names);
+# anything else is a mislabeled file.
+EXTENSION_CODECS = {
+    ".mp3": ("mp3",),
+    ".m4a": ("aac", "alac", "mp3"),
+    ".aac": ("aac",),
+    ".flac": ("flac",),
+    ".wav": ("pcm",),
+    ".ogg": ("vorbis", "opus", "flac"),
+    ".oga": ("vorbis", "opus", "flac"),
+    ".opus": ("opus",),
+}
+# Codec of each mutagen file type, named like ffprobe does.
+MUTAGEN_CODECS = {"mp3": "mp3", "easymp3": "mp3", "flac": "flac", "oggflac": "flac",
+                  "oggvorbis": "vorbis", "oggopus": "opus", "wave": "pcm", "aac": "aac"}
+
+# ffprobe ships with ffmpeg; without it the container info is read by
+# mutagen, which cannot tell a broken stream from a good one as reliably.
+ffprobe_path = shutil.which("ffprobe")
+
+
+def _int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _lower_keys(tags):
+    return {key.lower(): value for key, value in (tags or {}).items()}
+
+
+def probe_ffprobe(file_path):
+    """
+    Read duration, codec, bitrate, sample rate and tags with one ffprobe run.
+    """
+    cmd = [ffprobe_path, "-v", "error", "-print_format", "json",
+           "-show_format", "-show_streams", file_path]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+    if result.returncode != 0:
+        return {"error": result.stderr.decode(errors="replace").strip() or "ffprobe failed"}
+    data = json.loads(result.stdout or b"{}")
+    fmt = data.get("format", {})
+    audio = next((s for s in data.get("streams", []) if s.get("codec_type") == "audio"), None)
+    if audio is None:
+        return {"error": "no audio stream"}
+    return {
+        "duration": _float(audio.get("duration")) or _float(fmt.get("duration")),
+        "codec": audio.get("codec_name"),
+        "bitrate": _int(audio.get("bit_rate")) or _int(fmt.get("bit_rate")),
+        "sample_rate": _int(audio.get("sample_rate")),
+        "channels": _int(audio.get("channels")),
+        "format": fmt.get("format_name"),
+        "tags": {**_lower_keys(audio.get("tags")), **_lower_keys(fmt.get("tags"))},
+    }
+
+
+def probe_mutagen(file_path):
+    """
+    Fallback for hosts without ffprobe.
+    """
+    try:
+        audio = mutagen.File(file_path, easy=True)
+    except Exception as e:
+        return {"error": str(e)}
+    if audio is None or not getattr(audio, "info", None):
+        return {"error": "unrecognized format"}
+    info = audio.info
+    codec = MUTAGEN_CODECS.get(type(audio).__name__.lower(), getattr(info, "codec", None))
+    if codec and codec.startswith("mp4a"):
+        codec = "aac"
+    tags = {key: value[0] for key, value in (audio.tags or {}).items() if value}
+    return {
+        "duration": getattr(info, "length", None),
+        "codec": codec,
+        "bitrate": getattr(info, "bitrate", None),
+        "sample_rate": getattr(info, "sample_rate", None),
+        "channels": getattr(info, "channels", None),
+        "format": type(audio).__name__.lower(),
+        "tags": tags,
+    }
+
+
+def probe(file_path):
+    if ffprobe_path:
+        try:
+            return probe_ffprobe(file_path)
+        except (OSError, subprocess.TimeoutExpired, ValueError) as e:
+            return {"error": str(e)}
+    return probe_mutagen(file_path)
+
+
+class MediaInfoCache:
+    """
+    Result of probe() per file, keyed by path, size and mtime so each
+    version of a file is probed once no matter how many stages ask.
+    """
+
+    def __init__(self, db_path=MEDIA_INFO_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS media_info (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                info TEXT NOT NULL,
+                probed REAL NOT NULL
+            )""")
+        self._conn.commit()
+
+    def get(self, file_path):
+        """
+        Media info of the file, probing it if it is new or has changed.
+        """
+        file_path = os.path.abspath(file_path)
+        st = os.stat(file_path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, info FROM media_info WHERE path = ?",
+                (file_path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return json.loads(row[2])
+        info = probe(file_path)
+        log.debug(f"Probed {file_path}: {info}")
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO media_info (path, size, mtime_ns, info, probed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (file_path, st.st_size, st.st_mtime_ns, json.dumps(info), time.time()))
+            self._conn.execute(
+                "DELETE FROM media_info WHERE path IN ("
+                "SELECT path FROM media_info ORDER BY probed DESC LIMIT -1 OFFSET ?)",
+                (max_entries,))
+            self._conn.commit()
+        return info
+
+
+media_info_cache = MediaInfoCache()
+
+
+def media_info(file_path):
+    return media_info_cache.get(file_path)
+
+
+def media_duration(file_path):
+    """
+    Duration in seconds, or None if unknown or the file cannot be read.
+    """
+    try:
+        return media_info(file_path).get("duration")
+    except OSError:
+        return None
+
+
+def check_media(file_path, info):
+    """
+    Reason to quarantine the file instead of processing it, or None.
+    """
+    if info.get("error"):
+        return f"unreadable: {info['error']}"
+    duration = info.get("duration")
+    if not duration:
+        return "unknown duration"
+    if duration < min_duration:
+        return f"too short ({duration:.1f}s < {min_duration:g}s)"
+    codec = info.get("codec")
+    extension = os.path.splitext(file_path)[1].lower()
+    allowed = EXTENSION_CODECS.get(extension)
+    if codec and allowed and not codec.startswith(allowed):
+        return f"{codec} audio in a {extension} file"
+    return None
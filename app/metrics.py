@@ -0,0 +1,186 @@
+import contextlib
+import threading
+import time
+import logger as logger
+
+log = logger.logger
+
+NAMESPACE = "music_watchdog"
+# Histogram bucket upper bounds in seconds, from a tag write up to a long
+# conversion or upload.
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+HELP = {
+    "stage_seconds": "Time spent per pipeline stage.",
+    "files_total": "Files finished by the pipeline, by result.",
+    "recognitions_total": "Shazam recognition calls, by result (matched, rejected by is_match, no_match, error).",
+    "recognition_cache_total": "Recognition cache lookups, by result.",
+    "jobs_resumed_total": "Files resumed from a stage recorded before a restart or failure.",
+    "fingerprint_total": "Local fingerprint lookups, by result (hit, miss, rejected by is_match).",
+    "uploads_total": "SFTP uploads, by result.",
+    "upload_bytes_total": "Bytes sent over SFTP.",
+    "moves_total": "Files handed between folders, by method (rename, or copy across devices).",
+    "slack_messages_total": "Slack webhook posts, by result.",
+    "queue_depth": "Files waiting for a worker.",
+    "input_backlog": "Files in the input folder.",
+    "unrecognized_backlog": "Files in the unrecognized folder.",
+    "pending_uploads": "Recognized files waiting in the processed folder for upload.",
+}
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class Metrics:
+    """
+    In-process counters, gauges and stage histograms, safe to update from
+    the event loop and from worker threads.
+
+    Gauges are registered as callables and evaluated when rendered, so
+    values such as backlog sizes cost nothing between scrapes. render()
+    produces the Prometheus text format, snapshot() the JSON status page.
+    """
+
+    def __init__(self, namespace=NAMESPACE, buckets=STAGE_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._info = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                # Cumulative bucket counts, then sum, count and max.
+                hist = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-3] += seconds
+            hist[-2] += 1
+            hist[-1] = max(hist[-1], seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """
+        Record the duration of the enclosed block under `stage`, whether it
+        succeeds or raises. Usable in sync and async code.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.monotonic() - start, stage=stage)
+
+    def register_gauge(self, name, func):
+        self._gauges[name] = func
+
+    def register_info(self, name, func):
+        """
+        Add a non-numeric value (e.g. throttle state) to the status page.
+        """
+        self._info[name] = func
+
+    def _gauge_values(self):
+        values = {}
+        for name, func in list(self._gauges.items()):
+            try:
+                values[name] = func()
+            except Exception as e:
+                log.debug(f"Gauge {name} unavailable: {e}")
+        return values
+
+    def render(self):
+        """
+        Prometheus text exposition format (version 0.0.4).
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {self.namespace}_{name} {HELP[name]}")
+                lines.append(f"# TYPE {self.namespace}_{name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{self.namespace}_{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), hist in sorted(histograms.items()):
+            header(name, "histogram")
+            metric = f"{self.namespace}_{name}"
+            for bound, count in zip(self.buckets, hist):
+                lines.append(f"{metric}_bucket{_format_labels(labels, [('le', f'{bound:g}')])} {count}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {hist[-2]}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {hist[-3]:.6f}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {hist[-2]}")
+        for name, value in sorted(self._gauge_values().items()):
+            header(name, "gauge")
+            lines.append(f"{self.namespace}_{name} {_format_value(value)}")
+        lines.append(f"# TYPE {self.namespace}_uptime_seconds gauge")
+        lines.append(f"{self.namespace}_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Current values as a JSON-serializable dict for the status page.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+        status = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started)),
+            "uptime_seconds": round(time.time() - self.started),
+            "gauges": self._gauge_values(),
+            "counters": {},
+            "stages": {},
+        }
+        for (name, labels), value in sorted(counters.items()):
+            label = ",".join(f"{k}={v}" for k, v in labels) or "total"
+            status["counters"].setdefault(name, {})[label] = value
+        for (name, labels), hist in sorted(histograms.items()):
+            stage = dict(labels).get("stage", name)
+            count = hist[-2]
+            status["stages"][stage] = {
+                "count": count,
+                "total_seconds": round(hist[-3], 3),
+                "mean_seconds": round(hist[-3] / count, 3) if count else 0.0,
+                "max_seconds": round(hist[-1], 3),
+            }
+        for name, func in list(self._info.items()):
+            try:
+                status[name] = func()
+            except Exception as e:
+                status[name] = f"unavailable: {e}"
+        return status
+
+
+metrics = Metrics()
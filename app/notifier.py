@@ -1,28 +1,188 @@
-import requests
+import asyncio
 import os
+import aiohttp
+import requests
 import logger as logger
+from metrics import metrics
 
 log = logger.logger
 
 webhook_url = os.environ.get("SLACK_WEBHOOK_URL", None)
+# Messages arriving within this many seconds are sent as one digest.
+digest_seconds = float(os.environ.get("SLACK_DIGEST_SECONDS", "60"))
+# Pending messages kept before new ones are dropped (and counted).
+queue_size = int(os.environ.get("SLACK_QUEUE_SIZE", "1000"))
+# Detail lines listed under a digest's summary line.
+digest_max_lines = int(os.environ.get("SLACK_DIGEST_MAX_LINES", "10"))
+request_timeout = 10
+max_attempts = 4
+
+# Order of the counters in the digest summary.
+KINDS = ["recognized", "rejected", "uploaded", "failed"]
+
+
+class SlackNotifier:
+    """
+    Non-blocking Slack notifications.
+
+    notify() only puts the message on a bounded queue (from the event loop
+    or any thread) and never waits on the network. A background task drains
+    the queue, coalesces everything that arrived within `digest_seconds`
+    into one message such as "12 recognized, 11 uploaded, 1 failed", and
+    posts it over a pooled aiohttp session with retries, honouring Slack's
+    429 Retry-After. When the queue is full, messages are dropped and
+    reported as a count in the next digest.
+    """
+
+    def __init__(self, url=None, interval=None, max_queue=None, max_lines=None):
+        self.url = url or webhook_url
+        self.interval = digest_seconds if interval is None else interval
+        self.max_queue = max_queue or queue_size
+        self.max_lines = max_lines or digest_max_lines
+        self.loop = None
+        self.queue = None
+        self.task = None
+        self.dropped = 0
+        self._pending = []
+
+    def start(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.task = self.loop.create_task(self._run())
+
+    async def stop(self):
+        """
+        Send whatever is still queued, then stop the background task.
+        """
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        batch, self._pending = self._drain(self._pending), []
+        if batch:
+            async with aiohttp.ClientSession() as session:
+                await self._post(session, self._digest(batch))
+        self.task = None
+        self.loop = None
+
+    def notify(self, message, kind="info"):
+        if not self.url:
+            log.error("SLACK_WEBHOOK_URL is not set.")
+            return False
+        if self.loop is None:
+            # Not running inside the daemon (CLI tools): post directly.
+            return self._post_sync(message)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._enqueue(kind, message)
+        else:
+            self.loop.call_soon_threadsafe(self._enqueue, kind, message)
+        return True
 
+    def _enqueue(self, kind, message):
+        try:
+            self.queue.put_nowait((kind, message))
+        except asyncio.QueueFull:
+            self.dropped += 1
 
-def send_slack_notification(message: str) -> bool:
-    if not webhook_url:
-        log.error("SLACK_WEBHOOK_URL is not set.")
+    def _drain(self, batch):
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    def _digest(self, batch):
+        if self.dropped:
+            batch = batch + [("dropped", f"{self.dropped} notification(s) dropped under load")]
+            self.dropped = 0
+        if len(batch) == 1:
+            return batch[0][1]
+        counts = {}
+        for kind, _ in batch:
+            counts[kind] = counts.get(kind, 0) + 1
+        summary = ", ".join(f"{counts[kind]} {kind}" for kind in KINDS if kind in counts)
+        lines = [f"Music Watchdog: {summary}"] if summary else []
+        details = [message for _, message in batch]
+        lines += [f"• {message}" for message in details[:self.max_lines]]
+        if len(details) > self.max_lines:
+            lines.append(f"… and {len(details) - self.max_lines} more")
+        return "\n".join(lines)
+
+    async def _run(self):
+        timeout = aiohttp.ClientTimeout(total=request_timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                self._pending = [await self.queue.get()]
+                # Let a burst accumulate, then send it as one message.
+                await asyncio.sleep(self.interval)
+                batch, self._pending = self._drain(self._pending), []
+                await self._post(session, self._digest(batch))
+
+    async def _post(self, session, message):
+        with metrics.timed("slack"):
+            sent = await self._send(session, message)
+        metrics.inc("slack_messages_total", result="sent" if sent else "failed")
+        return sent
+
+    async def _send(self, session, message):
+        log.debug(f"Sending Slack notification: {message}")
+        delay = 1.0
+        for attempt in range(1, max_attempts + 1):
+            try:
+                async with session.post(self.url, json={"text": message}) as response:
+                    if response.status == 429:
+                        delay = float(response.headers.get("Retry-After", delay))
+                        log.warning(
+                            f"Slack rate limited the webhook, retrying in {delay:g}s")
+                    elif response.status >= 500:
+                        log.warning(
+                            f"Slack returned {response.status} (attempt {attempt}/{max_attempts})")
+                    else:
+                        response.raise_for_status()
+                        log.info(f"Slack notification sent: {message}")
+                        return True
+            except aiohttp.ClientResponseError as error:
+                log.error(f"Failed to send Slack notification: {error}")
+                return False
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                log.warning(
+                    f"Slack notification failed (attempt {attempt}/{max_attempts}): {error}")
+            if attempt < max_attempts:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+        log.error(f"Giving up on Slack notification: {message}")
         return False
+
+    def _post_sync(self, message):
+        log.debug(f"Sending Slack notification: {message}")
+        try:
+            with metrics.timed("slack"):
+                response = requests.post(
+                    self.url, json={"text": message}, timeout=request_timeout)
+            response.raise_for_status()
+            log.info(f"Slack notification sent: {message}")
+        except requests.RequestException as error:
+            log.error(f"Failed to send Slack notification: {error}")
+            metrics.inc("slack_messages_total", result="failed")
+            return False
+        metrics.inc("slack_messages_total", result="sent")
+        return True
+
+
+notifier = SlackNotifier()
+
+
+def send_slack_notification(message: str, kind: str = "info") -> bool:
+    """
+    Queue a Slack notification. `kind` (recognized, rejected, uploaded,
+    failed, info) is used to summarize bursts in the digest.
+    """
     if not message:
         log.error("Message is empty.")
         return False
-    log.debug(f"Sending Slack notification: {message}")
-
-    # Send the notification
-    payload = {"text": message}
-    try:
-        response = requests.post(webhook_url, json=payload)
-        response.raise_for_status()
-        log.info(f"Slack notification sent: {message}")
-    except requests.RequestException as error:
-        log.error(f"Failed to send Slack notification: {error}")
-        return False
-    return True
+    return notifier.notify(message, kind)
@@ -0,0 +1,196 @@
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+import numpy as np
+import logger as logger
+
+log = logger.logger
+
+PROBE_ANALYSIS_DB = os.getenv("PROBE_ANALYSIS_DB", os.path.join(
+    os.path.dirname(__file__), "..", "probe_analysis.db"))
+# "energy" ranks windows by the envelope below; "fixed" uses PROBE_WINDOWS.
+probe_strategy = os.getenv("PROBE_STRATEGY", "energy").lower()
+# Windows sent to Shazam at most per file when probing by energy.
+probe_count = int(os.getenv("PROBE_COUNT", "3"))
+max_entries = int(os.getenv("PROBE_ANALYSIS_MAX_ENTRIES", "100000"))
+
+ENVELOPE_RATE = 4000
+FRAME = 250  # 62.5 ms, 16 frames per second
+FRAMES_PER_SECOND = ENVELOPE_RATE // FRAME
+BLOCK_SECONDS = 10
+# Seconds quieter than this (absolute, or relative to the loudest second)
+# count as silence.
+SILENCE_DB = -50.0
+DYNAMIC_RANGE_DB = 30.0
+# Windows scoring below this fraction of the best one are not worth a call.
+MIN_RELATIVE_SCORE = 0.5
+
+
+def compute_envelope(file_path):
+    """
+    Decode the whole file once at 4 kHz mono and reduce it to per-second
+    RMS level and spectral flux. PCM is read from ffmpeg in blocks of
+    BLOCK_SECONDS, so only one block is ever held in memory.
+    Returns a float32 array of shape (2, seconds).
+    """
+    ffmpeg_cmd = ["ffmpeg", "-v", "error", "-nostdin", "-i", file_path,
+                  "-vn", "-ac", "1", "-ar", str(ENVELOPE_RATE), "-f", "s16le", "pipe:1"]
+    proc = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE)
+    window = np.hanning(FRAME).astype(np.float32)
+    energy, flux = [], []
+    previous = None
+    carry = b""
+    try:
+        while True:
+            data = proc.stdout.read(ENVELOPE_RATE * 2 * BLOCK_SECONDS)
+            if not data:
+                break
+            data = carry + data
+            usable = len(data) // (FRAME * 2) * (FRAME * 2)
+            carry = data[usable:]
+            if not usable:
+                continue
+            frames = np.frombuffer(data[:usable], dtype="<i2").astype(np.float32)
+            frames = frames.reshape(-1, FRAME) / 32768.0
+            energy.append(np.mean(frames * frames, axis=1))
+            magnitude = np.abs(np.fft.rfft(frames * window, axis=1))
+            if previous is None:
+                previous = magnitude[:1]
+            rise = np.diff(np.concatenate((previous, magnitude)), axis=0)
+            # Normalized by the frame's own magnitude so flux measures change,
+            # not loudness.
+            flux.append(np.maximum(rise, 0).sum(axis=1) / (magnitude.sum(axis=1) + 1e-9))
+            previous = magnitude[-1:]
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, ffmpeg_cmd)
+    if not energy:
+        return np.zeros((2, 0), dtype=np.float32)
+    energy, flux = np.concatenate(energy), np.concatenate(flux)
+    seconds = int(np.ceil(len(energy) / FRAMES_PER_SECOND))
+    pad = seconds * FRAMES_PER_SECOND - len(energy)
+    # A partial last second is padded with its own mean.
+    energy = np.pad(energy, (0, pad), mode="mean").reshape(seconds, -1).mean(axis=1)
+    flux = np.pad(flux, (0, pad), mode="mean").reshape(seconds, -1).mean(axis=1)
+    return np.stack((np.sqrt(energy), flux)).astype(np.float32)
+
+
+def _sliding_mean(values, width):
+    total = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+    return (total[width:] - total[:-width]) / width
+
+
+def rank_offsets(envelope, window_sec, count):
+    """
+    Choose up to `count` non-overlapping window start offsets (seconds),
+    best first. A window scores high when it is loud relative to the track,
+    free of silence, steady in level and has onsets; spoken intros (level
+    gaps), fades and silence score low. A file shorter than one window
+    gets a single window at 0; weak windows are dropped, so clear tracks
+    cost fewer Shazam calls when nothing matches.
+    """
+    rms, flux = envelope
+    width = max(1, int(np.ceil(window_sec)))
+    if len(rms) <= width:
+        return [0.0]
+    level = 20 * np.log10(rms + 1e-6)
+    active = level > max(SILENCE_DB, level.max() - DYNAMIC_RANGE_DB)
+    if not active.any():
+        return [0.0]
+    loudness = np.clip(1 + (level - level.max()) / DYNAMIC_RANGE_DB, 0, 1)
+    onsets = np.clip(flux / (np.median(flux[active]) + 1e-9), 0, 1)
+    per_second = active * (loudness + onsets) / 2
+    mean_level = _sliding_mean(level, width)
+    spread = np.sqrt(np.maximum(_sliding_mean(level * level, width) - mean_level ** 2, 0))
+    scores = _sliding_mean(per_second, width) / (1 + spread / 6.0)
+
+    offsets = []
+    starts = np.arange(len(scores))
+    floor = scores.max() * MIN_RELATIVE_SCORE
+    while len(offsets) < count:
+        best = int(np.argmax(scores))
+        if offsets and not scores[best] >= floor:
+            break
+        offsets.append(float(best))
+        scores[np.abs(starts - best) < width] = -np.inf
+    return offsets
+
+
+class ProbeAnalysisCache:
+    """
+    Envelopes from compute_envelope() keyed by audio hash, so a file that
+    is retried or re-dropped is not decoded again. Offsets are ranked from
+    the envelope on each use, since that is cheap and depends on the
+    window length.
+    """
+
+    def __init__(self, db_path=PROBE_ANALYSIS_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS envelopes (
+                hash TEXT PRIMARY KEY,
+                envelope BLOB NOT NULL,
+                created REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS envelopes_created ON envelopes (created)")
+        self._conn.commit()
+
+    def get(self, content_hash):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT envelope FROM envelopes WHERE hash = ?", (content_hash,)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).reshape(2, -1)
+
+    def put(self, content_hash, envelope):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO envelopes (hash, envelope, created) VALUES (?, ?, ?)",
+                (content_hash, envelope.astype(np.float32).tobytes(), time.time()))
+            self._conn.execute(
+                "DELETE FROM envelopes WHERE hash IN ("
+                "SELECT hash FROM envelopes ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (max_entries,))
+            self._conn.commit()
+
+    def envelope(self, file_path, content_hash=None):
+        """
+        Cached envelope for the file, computing and storing it on a miss.
+        """
+        envelope = self.get(content_hash) if content_hash else None
+        if envelope is None:
+            envelope = compute_envelope(file_path)
+            if content_hash:
+                self.put(content_hash, envelope)
+        return envelope
+
+
+def select_probe_offsets(file_path, duration_sec, content_hash=None):
+    """
+    Probe offsets for the file ranked by musical energy, or None to use
+    the fixed PROBE_WINDOWS (strategy "fixed", or the analysis failed).
+    """
+    if probe_strategy != "energy":
+        return None
+    try:
+        envelope = probe_analysis_cache.envelope(file_path, content_hash)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning(f"Probe analysis failed for {file_path} ({e}); using fixed windows")
+        return None
+    if not envelope.shape[1]:
+        return None
+    offsets = rank_offsets(envelope, duration_sec, probe_count)
+    log.debug(f"Probe offsets for {os.path.basename(file_path)} by energy: {offsets}")
+    return offsets
+
+
+probe_analysis_cache = ProbeAnalysisCache()
@@ -1,15 +1,37 @@
 import os
 import shutil
 import asyncio
+import time
+import subprocess
 import logger as logger
-import convert_m4a
-from utils import alphanum_key, split_audio_file
-from recognize import recognize
-from sftp_upload import upload_file_sftp
+import transcode
+import staging
+from utils import split_audio_file, extract_probe_windows
+from recognize import recognize, accept_track, is_match
+from fingerprint import fingerprint_index, fingerprint_enabled
+from recognition_cache import recognition_cache, audio_hash
+from probe_analysis import select_probe_offsets
+from tracklist import is_mix, recognize_mix, accept_mix, write_sidecars
+from media_info import media_info, check_media, EXTENSION_CODECS
+from notifier import send_slack_notification
+from cover_art import cover_cache
+from job_store import job_store, reached
+from watcher import file_key
+import sftp_upload
+from metrics import metrics
 import unicodedata
 
 log = logger.logger
 
+# "stream" pipes probe windows from ffmpeg straight to Shazam as bytes;
+# "files" writes them to a split folder next to the input first.
+probe_mode = os.getenv("PROBE_MODE", "stream").lower()
+
+SUPPORTED_EXTENSIONS = tuple(EXTENSION_CODECS)
+# Accept title/artist tags a file already carries when they agree with its
+# name, instead of asking Shazam.
+trust_existing_tags = os.getenv("TRUST_EXISTING_TAGS", "true").lower() == "true"
+
 
 def sanitize_filename(filename):
     """
@@ -26,27 +48,34 @@ def sanitize_filename(filename):
     return ascii_filename
 
 
-async def handle_conversion(file, path_to_dir):
+async def transcode_matched(file, original_file_path, track_data):
     """
-    Convert m4a files to mp3. Return the file name and its path.
+    Transcode a recognized file to the target format (TARGET_CODEC),
+    replacing the source; files already in that format are left alone.
+    The cover art is fetched while ffmpeg runs, so tagging can start as
+    soon as the new file is in place. Returns the path of the file to tag.
     """
-    original_file_path = os.path.join(path_to_dir, file)
-    if file.lower().endswith('.m4a'):
-        log.info(f"Converting m4a file: {file}")
-        mp3_file = convert_m4a.convert_m4a_to_mp3(
-            original_file_path, output_dir=path_to_dir)
-        log.debug(f"Conversion complete: {mp3_file}")
+    if not await asyncio.to_thread(transcode.needs_transcode, original_file_path):
+        return original_file_path
+    log.info(f"Transcoding {file} to {transcode.target_codec}")
+
+    async def run():
+        with metrics.timed("conversion"):
+            return await transcode.transcode_async(original_file_path)
+
+    cover_url = (track_data or {}).get("images", {}).get("coverart")
+    new_path, _ = await asyncio.gather(run(), cover_cache.get(cover_url))
+    log.debug(f"Transcoding complete: {new_path}")
+    if new_path != original_file_path:
         os.remove(original_file_path)
-        file = os.path.basename(mp3_file)
-        original_file_path = mp3_file
-    return file, original_file_path
+    return new_path
 
 
 def prepare_split_folder(file, path_to_dir):
     """
     Prepare a folder for split audio chunks.
     """
-    split_folder = file.split(".")[0]
+    split_folder = file_key(file)
     path_to_split_folder = os.path.join(path_to_dir, split_folder)
     if not os.path.exists(path_to_split_folder):
         # Create the split folder if it doesn't exist
@@ -55,45 +84,146 @@ def prepare_split_folder(file, path_to_dir):
     return path_to_split_folder
 
 
-async def process_chunks(file, original_file_path, path_to_split_folder, music_segment_duration, skip_chunk, check_delay, output_file, shazam):
+async def process_windows_stream(file, original_file_path, music_segment_duration, shazam,
+                                 offsets=None):
+    """
+    Streaming variant of process_chunks: probe windows are decoded into
+    memory and sent to Shazam as bytes, so nothing is written to the input
+    volume. Returns (recognized_success, track_data).
+    """
+    with metrics.timed("split"):
+        windows = await asyncio.to_thread(extract_probe_windows, original_file_path,
+                                          music_segment_duration, offsets=offsets)
+    log.info(f"Starting recognition for file: {file}")
+
+    best_track = None
+    for offset, wav_bytes in windows:
+        label = f"{file}@{offset:g}s"
+        log.debug(f"Processing window: {label}")
+        recognized, track_data = await recognize(wav_bytes, original_file_path, shazam,
+                                                 label=label)
+        best_track = track_data or best_track
+        if recognized:
+            log.info(
+                f"Recognition succeeded on window at {offset:g}s for file: {file}")
+            return True, track_data
+    return False, best_track
+
+
+async def recognize_file(file, original_file_path, path_to_dir, music_segment_duration, shazam,
+                         content_hash=None):
     """
-    Split the audio file into chunks and try to recognize the song on each chunk.
-    The split_audio_file function is now passed a start_offset (in ms) to choose a segment beyond the beginning.
+    Run recognition in the configured probe mode. Probe offsets come from
+    the energy analysis (cached by `content_hash`) unless it is disabled.
+    Streaming falls back to the split-folder path if ffmpeg cannot pipe
+    the windows.
     """
-    # Set the desired start offset to 45 seconds (45000 milliseconds)
-    segment_offset = 45000
+    with metrics.timed("analysis"):
+        offsets = await asyncio.to_thread(select_probe_offsets, original_file_path,
+                                          music_segment_duration / 1000.0, content_hash)
+    if probe_mode == "stream":
+        try:
+            return await process_windows_stream(file, original_file_path, music_segment_duration,
+                                                shazam, offsets=offsets)
+        except subprocess.CalledProcessError as e:
+            log.warning(
+                f"Streaming probe failed for {file} ({e}); falling back to split folder")
+    # Prepare the folder for split chunks
+    path_to_split_folder = prepare_split_folder(file, path_to_dir)
+    return await process_chunks(file, original_file_path, path_to_split_folder,
+                                music_segment_duration, shazam, offsets=offsets)
 
+
+async def process_chunks(file, original_file_path, path_to_split_folder, music_segment_duration, shazam,
+                         offsets=None):
+    """
+    Extract the probe windows and try to recognize the song on each chunk,
+    in priority order, stopping at the first match.
+    Returns (recognized_success, track_data) for the recognition cache.
+    """
     log.debug(
-        f"Splitting file {file} into folder: {path_to_split_folder} starting at offset {segment_offset} ms")
-    # Update the split_audio_file to accept a start_offset parameter.
-    split_audio_file(original_file_path, path_to_split_folder,
-                     music_segment_duration, skip_chunk, start_offset=segment_offset)
-    split_files = [f for f in os.listdir(path_to_split_folder)
-                   if os.path.isfile(os.path.join(path_to_split_folder, f))]
-    split_files = sorted(split_files, key=alphanum_key)
+        f"Splitting file {file} into probe windows in folder: {path_to_split_folder}")
+    with metrics.timed("split"):
+        chunk_paths = await asyncio.to_thread(split_audio_file, original_file_path, path_to_split_folder,
+                                              music_segment_duration, offsets=offsets)
+    split_files = [os.path.basename(p) for p in chunk_paths
+                   if os.path.isfile(p) and os.path.getsize(p) > 0]
     log.info(f"Starting recognition for file: {file}")
 
     recognized_success = False
-    for split_file in split_files:
-        await asyncio.sleep(check_delay)
-        chunk_path = os.path.join(path_to_split_folder, split_file)
-        log.debug(f"Processing chunk: {split_file}")
-        recognized = await recognize(chunk_path, original_file_path, output_file, shazam)
-        if recognized:
-            recognized_success = True
-            log.info(
-                f"Recognition succeeded on chunk: {split_file} for file: {file}")
-            break
-    # Clean up split folder
-    shutil.rmtree(path_to_split_folder, ignore_errors=True)
-    return recognized_success
+    best_track = None
+    try:
+        for split_file in split_files:
+            chunk_path = os.path.join(path_to_split_folder, split_file)
+            log.debug(f"Processing chunk: {split_file}")
+            recognized, track_data = await recognize(chunk_path, original_file_path, shazam)
+            best_track = track_data or best_track
+            if recognized:
+                recognized_success = True
+                log.info(
+                    f"Recognition succeeded on chunk: {split_file} for file: {file}")
+                break
+    finally:
+        # Clean up split folder
+        shutil.rmtree(path_to_split_folder, ignore_errors=True)
+    return recognized_success, best_track
+
+
+async def match_fingerprint(file, original_file_path):
+    """
+    Look the file up in the local fingerprint index. Returns the stored
+    track_data of a confident hit that also passes is_match, else None.
+    """
+    if not fingerprint_enabled:
+        return None
+    try:
+        with metrics.timed("fingerprint"):
+            result = await asyncio.to_thread(fingerprint_index.lookup_file, original_file_path)
+    except subprocess.CalledProcessError as e:
+        log.warning(f"Fingerprinting failed for {file}: {e}")
+        return None
+    if result is None:
+        metrics.inc("fingerprint_total", result="miss")
+        return None
+    track_data, score = result
+    recognized_artist = track_data.get("subtitle", "")
+    recognized_title = track_data.get("title", "")
+    if not await asyncio.to_thread(is_match, recognized_artist, recognized_title, original_file_path):
+        log.debug(
+            f"Fingerprint match {recognized_artist} - {recognized_title} rejected for {file}")
+        metrics.inc("fingerprint_total", result="rejected")
+        return None
+    log.info(
+        f"Local fingerprint match for {file}: {recognized_artist} - {recognized_title} (score {score})")
+    metrics.inc("fingerprint_total", result="hit")
+    return track_data
 
 
-def move_file(original_file_path, file, path_to_dir, processed_folder, recognized_success):
+async def index_fingerprint(file, original_file_path, content_hash, track_data):
+    """
+    Add a recognized file to the local fingerprint index.
+    """
+    if not fingerprint_enabled:
+        return
+    try:
+        with metrics.timed("fingerprint_index"):
+            await asyncio.to_thread(fingerprint_index.add_file, original_file_path,
+                                    content_hash, track_data)
+    except Exception as e:
+        log.warning(f"Could not fingerprint {file}: {e}")
+
+
+def move_file(original_file_path, file, path_to_dir, processed_folder, recognized_success,
+              stage_key=None):
     """
     Move the processed file to the correct folder after sanitizing its filename.
+    With `stage_key`, a recognized file is renamed into staging on the input
+    volume instead, to be uploaded from there.
     """
-    if recognized_success:
+    if recognized_success and stage_key:
+        dest_folder = os.path.dirname(staging.stage_path(path_to_dir, stage_key, file))
+        os.makedirs(dest_folder, mode=0o777, exist_ok=True)
+    elif recognized_success:
         dest_folder = processed_folder
     else:
         dest_folder = os.path.join(path_to_dir, "unrecognized")
@@ -105,51 +235,275 @@ def move_file(original_file_path, file, path_to_dir, processed_folder, recognize
     safe_filename = sanitize_filename(file)
     dest_path = os.path.join(dest_folder, safe_filename)
     log.info(f"Moving file from {original_file_path} to {dest_path}")
-    shutil.move(original_file_path, dest_path)
+    with metrics.timed("move"):
+        staging.move(original_file_path, dest_path)
     return dest_path  # Return new path after moving
 
 
-async def process_file(file, path_to_dir, processed_folder, music_segment_duration, skip_chunk, check_delay, output_file, shazam):
+def quarantine_file(file_path, path_to_dir, reason):
+    """
+    Move a file that cannot be processed to the quarantine folder and note
+    why in quarantine.log there. Returns the new path.
+    """
+    quarantine_folder = os.path.join(path_to_dir, "quarantine")
+    os.makedirs(quarantine_folder, mode=0o777, exist_ok=True)
+    dest_path = os.path.join(quarantine_folder, os.path.basename(file_path))
+    shutil.move(file_path, dest_path)
+    with open(os.path.join(quarantine_folder, "quarantine.log"), "a", encoding="utf-8") as f:
+        f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')}\t{os.path.basename(file_path)}\t{reason}\n")
+    return dest_path
+
+
+async def cached_result(file, original_file_path, track_data):
+    """
+    Verdict for a cached Shazam result. The cache is keyed by the audio
+    alone, so the result is checked against this file's name again rather
+    than trusting the verdict stored for whichever copy was seen first.
+    Returns (recognized_success, track_data).
     """
-    Coordinator: convert (if needed), split the audio,
-    recognize song chunks, move the file, and then attempt SFTP upload.
+    if track_data is None:
+        return False, None
+    if track_data.get("tracklist") is not None:
+        # Mix: the tracklist does not depend on the name, only its title does.
+        track_data = dict(track_data, title=os.path.splitext(file)[0])
+        return any(segment["title"] is not None for segment in track_data["tracklist"]), track_data
+    recognized_artist = track_data.get("subtitle", "")
+    recognized_title = track_data.get("title", "")
+    if not await asyncio.to_thread(is_match, recognized_artist, recognized_title, original_file_path):
+        log.debug(
+            f"Cached result {recognized_artist} - {recognized_title} rejected for {file}")
+        return False, track_data
+    return True, track_data
+
+
+async def tagged_track(file_path, info):
+    """
+    Track data from the title/artist tags the file already has, if they
+    agree with its name the way a Shazam result must. None otherwise. The
+    tags are not compared with themselves, only with the name.
+    """
+    tags = info.get("tags") or {}
+    artist, title = tags.get("artist"), tags.get("title")
+    if not (trust_existing_tags and artist and title):
+        return None
+    if not await asyncio.to_thread(is_match, artist, title, file_path, use_tags=False):
+        return None
+    return {"title": title, "subtitle": artist, "source": "tags"}
+
+
+async def process_file(file, path_to_dir, processed_folder, music_segment_duration, shazam,
+                       claims=None, key=None, upload=True):
+    """
+    Coordinator: recognize the file in its own format, transcode it once
+    it matched (if needed), tag and move it, and then attempt SFTP upload.
+    With `claims` (several instances on one volume), the upload is skipped
+    if another node is already uploading the same processed file.
+    `key` overrides the job key (the file stem) for callers walking nested
+    folders; `upload=False` stops after the move.
+    Returns the final job record, or None for unsupported or quarantined files.
     """
     log.debug(f"Starting processing for file: {file}")
 
-    if not (file.lower().endswith('.mp3') or file.lower().endswith('.m4a')):
+    if not file.lower().endswith(SUPPORTED_EXTENSIONS):
         log.info(f"Ignoring unsupported file format: {file}")
-        return
+        metrics.inc("files_total", result="skipped")
+        return None
 
-    # Handle file conversion
-    file, original_file_path = await handle_conversion(file, path_to_dir)
+    with metrics.timed("file"):
+        return await _process_file(file, path_to_dir, processed_folder, music_segment_duration,
+                                   shazam, claims, key or file_key(file), upload)
 
-    # Prepare the folder for split chunks
-    path_to_split_folder = prepare_split_folder(file, path_to_dir)
 
-    # Process chunks and attempt recognition
-    recognized_success = await process_chunks(file, original_file_path, path_to_split_folder,
-                                              music_segment_duration, skip_chunk, check_delay, output_file, shazam)
+async def _process_file(file, path_to_dir, processed_folder, music_segment_duration, shazam,
+                        claims, key, upload):
+    """
+    Body of process_file, timed as the "file" stage. Each completed stage
+    is committed to the job store, so a file interrupted by a restart
+    resumes after its last completed stage.
+    """
+    job = job_store.get(key)
+    if job is not None and not reached(job, "moved") and not os.path.exists(job["current_path"]):
+        transcoded = transcode.output_path(job["current_path"])
+        if reached(job, "recognized") and os.path.exists(transcoded):
+            # Stopped after the transcode replaced the source.
+            job = job_store.advance(key, "transcoded", current_path=transcoded)
+        else:
+            log.warning(f"File for job {key} is gone, starting over with {file}")
+            job = None
+    if job is None or reached(job, "moved"):
+        # New file (or a re-drop of one that already left the input folder).
+        # Files that are unreadable or too short never reach ffmpeg or Shazam.
+        source_path = os.path.join(path_to_dir, file)
+        reason = check_media(source_path, await asyncio.to_thread(media_info, source_path))
+        if reason:
+            log.warning(f"Quarantining {file}: {reason}")
+            await asyncio.to_thread(quarantine_file, source_path, path_to_dir, reason)
+            metrics.inc("files_total", result="quarantined")
+            send_slack_notification(f"Quarantined {file}: {reason}", kind="failed")
+            return None
+        # Hash the audio payload (tags excluded) before a transcode replaces the source.
+        content_hash = await asyncio.to_thread(audio_hash, source_path)
+        job = job_store.start(key, source_path, content_hash)
+    else:
+        job = job_store.resume(key)
+        log.info(f"Resuming {file} after stage '{job['stage']}' (attempt {job['attempts']})")
+        metrics.inc("jobs_resumed_total")
+
+    original_file_path = job["current_path"]
+    file = os.path.basename(original_file_path)
+
+    if not reached(job, "probed"):
+        cached = recognition_cache.get(job["content_hash"])
+        metrics.inc("recognition_cache_total", result="miss" if cached is None else "hit")
+        if cached is not None:
+            recognized_success, track_data = await cached_result(file, original_file_path, cached[1])
+            log.info(
+                f"Recognition cache hit for {file}: {'match' if recognized_success else 'no match'}")
+        elif await asyncio.to_thread(is_mix, original_file_path):
+            # A mix holds many tracks: build a tracklist instead of looking
+            # for a single title (the fingerprint index knows single tracks).
+            recognized_success, track_data = await recognize_mix(file, original_file_path, shazam)
+            recognition_cache.put(job["content_hash"], recognized_success, track_data)
+        else:
+            track_data = await tagged_track(original_file_path,
+                                            await asyncio.to_thread(media_info, original_file_path))
+            recognized_success = track_data is not None
+            if recognized_success:
+                # Not cached: the cache key ignores tags.
+                log.info(f"{file} is already tagged as {track_data['subtitle']} - {track_data['title']}")
+                metrics.inc("recognitions_total", result="tags")
+            else:
+                track_data = await match_fingerprint(file, original_file_path)
+                recognized_success = track_data is not None
+                if not recognized_success:
+                    # Probe the file and attempt recognition
+                    recognized_success, track_data = await recognize_file(file, original_file_path, path_to_dir,
+                                                                          music_segment_duration, shazam,
+                                                                          content_hash=job["content_hash"])
+                recognition_cache.put(job["content_hash"], recognized_success, track_data)
+        job = job_store.advance(key, "probed", matched=recognized_success, track_data=track_data)
+        if recognized_success:
+            job = job_store.advance(key, "recognized")
+    recognized_success = bool(job["matched"])
+    tracklist = job["track_data"] and job["track_data"].get("tracklist")
+
+    # Recognition ran on the source; only matched files are worth a transcode.
+    if recognized_success and not reached(job, "transcoded"):
+        original_file_path = await transcode_matched(file, original_file_path, job["track_data"])
+        job = job_store.advance(key, "transcoded", current_path=original_file_path)
+        file = os.path.basename(original_file_path)
 
+    if recognized_success and not reached(job, "tagged"):
+        if tracklist:
+            await accept_mix(job["track_data"], original_file_path)
+        else:
+            await accept_track(job["track_data"], original_file_path)
+            await index_fingerprint(file, original_file_path, job["content_hash"], job["track_data"])
+        job = job_store.advance(key, "tagged")
+
+    # Uploading straight from staging spares the copy into the processed
+    # folder (usually another volume) and reading it back from there.
+    staged = (recognized_success and upload and staging.upload_from_staging
+              and sftp_upload.sftp_configured())
     # Move the original file based on recognition outcome and get its new location.
-    new_file_path = move_file(original_file_path, file,
-                              path_to_dir, processed_folder, recognized_success)
+    new_file_path = await asyncio.to_thread(move_file, original_file_path, file,
+                                            path_to_dir, processed_folder, recognized_success,
+                                            stage_key=file_key(file) if staged else None)
+    sidecars = []
+    if recognized_success and tracklist:
+        # The cue sheet and JSON tracklist travel with the mix.
+        sidecars = await asyncio.to_thread(write_sidecars, new_file_path, job["track_data"])
+    job = job_store.advance(key, "moved", current_path=new_file_path)
+
+    metrics.inc("files_total", result="recognized" if recognized_success else "unrecognized")
 
     # If recognized successfully, attempt SFTP upload
-    if recognized_success:
-        # Retrieve SFTP credentials from environment variables.
-        sftp_username = os.environ.get("SFTP_USERNAME")
-        sftp_host = os.environ.get("SFTP_HOST")
-        sftp_password = os.environ.get("SFTP_PASSWORD")
-        sftp_port = int(os.environ.get("SFTP_PORT", "22"))
-        sftp_remote_dir = os.environ.get("SFTP_REMOTE_DIR", "/upload")
-        if sftp_username and sftp_host and sftp_password:
-            upload_success = upload_file_sftp(
-                new_file_path, sftp_username, sftp_host, sftp_password, sftp_port, sftp_remote_dir)
-            if not upload_success:
-                log.error(
-                    f"SFTP upload failed for {new_file_path}. File remains in processed folder.")
-        else:
+    if recognized_success and not upload:
+        log.debug(f"Upload disabled, leaving {new_file_path} in place")
+    elif recognized_success:
+        upload_key = upload_claim_key(new_file_path)
+        if not sftp_upload.sftp_configured():
             log.error("SFTP credentials not fully set. Skipping SFTP upload.")
+        elif claims is not None and not await asyncio.to_thread(claims.acquire, upload_key):
+            log.info(f"{new_file_path} is already being uploaded by another node")
+        else:
+            try:
+                upload_success = await asyncio.to_thread(
+                    sftp_upload.upload_file_sftp, new_file_path, sftp_upload.sftp_username, sftp_upload.sftp_host,
+                    sftp_upload.sftp_password, sftp_upload.sftp_port, sftp_upload.sftp_remote_dir)
+            finally:
+                if claims is not None:
+                    await asyncio.to_thread(claims.release, upload_key)
+            if upload_success:
+                job_store.advance(key, "uploaded")
+                if sidecars:
+                    # Failed ones stay in the processed folder for upload_pending.
+                    await asyncio.to_thread(sftp_upload.upload_files_sftp, sidecars)
+            else:
+                job_store.fail(key, "SFTP upload failed")
+                log.error(
+                    f"SFTP upload failed for {new_file_path}. It will be retried from the processed folder.")
     else:
         log.info(
             f"File {file} was not recognized. Moved to unrecognized folder.")
+    if staged:
+        # Whatever was not uploaded (failed, or claimed by another node)
+        # goes to the processed folder for upload_pending.
+        for path in [new_file_path, *sidecars]:
+            if os.path.exists(path):
+                processed_path = await asyncio.to_thread(staging.unstage, path, processed_folder)
+                job_store.relocate(path, processed_path)
+        try:
+            os.rmdir(os.path.dirname(new_file_path))
+        except OSError:
+            pass
+    return job_store.get(key)
+
+
+def upload_claim_key(file_path):
+    """
+    Lease key guarding the upload of a processed file.
+    """
+    return f"upload-{os.path.basename(file_path)}"
+
+
+def _is_split_folder(entry):
+    names = os.listdir(entry.path)
+    if not names:
+        # Created by prepare_split_folder before the split itself ran.
+        return job_store.get(entry.name) is not None
+    return all(name.startswith("chunk_") and name.endswith(".mp3") for name in names)
+
+
+def cleanup_artifacts(path_to_dir, in_use=None):
+    """
+    Remove temp files a crash can leave in the input folder: half-written
+    transcodes (".<name>.<ext>.part" of a file with a job) and split
+    folders of probe chunks. Other hidden ".part" files belong to whoever
+    is copying into the folder and are left alone. `in_use(key)` protects
+    files another instance is still working on.
+    Returns the number of entries removed.
+    """
+    extensions = tuple(settings["extension"] for settings in transcode.TARGETS.values())
+    removed = 0
+    with os.scandir(path_to_dir) as it:
+        entries = list(it)
+    for entry in entries:
+        transcode_temp = (entry.name.startswith(".") and entry.name.endswith(".part")
+                          and entry.name[:-len(".part")].lower().endswith(extensions))
+        key = file_key(entry.name[1:-len(".part")]) if transcode_temp else entry.name
+        if in_use is not None and in_use(key):
+            continue
+        try:
+            if transcode_temp and entry.is_file() and job_store.get(key) is not None:
+                os.remove(entry.path)
+            elif entry.is_dir() and entry.name != "unrecognized" and _is_split_folder(entry):
+                shutil.rmtree(entry.path)
+            else:
+                continue
+        except OSError as e:
+            log.warning(f"Could not remove leftover {entry.path}: {e}")
+            continue
+        log.info(f"Removed leftover temp artifact: {entry.path}")
+        removed += 1
+    return removed
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import logger as logger
+
+log = logger.logger
+
+CACHE_DB = os.getenv("RECOGNITION_CACHE_DB", os.path.join(
+    os.path.dirname(__file__), "..", "recognition_cache.db"))
+# Negative results (no track, or rejected by is_match when stored) are retried after this.
+negative_ttl_seconds = float(
+    os.getenv("RECOGNITION_CACHE_NEGATIVE_TTL_HOURS", "168")) * 3600
+max_age_seconds = float(
+    os.getenv("RECOGNITION_CACHE_MAX_AGE_DAYS", "365")) * 86400
+max_entries = int(os.getenv("RECOGNITION_CACHE_MAX_ENTRIES", "100000"))
+
+ID3V1_SIZE = 128
+
+
+def _id3v2_size(header):
+    """
+    Return the full size of an ID3v2 tag given its 10-byte header, or 0.
+    """
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    size = 0
+    for b in header[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    footer = 10 if header[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _flac_ranges(f, start, end):
+    # "fLaC", then metadata blocks (tags, pictures, padding) until the one
+    # flagged last; the audio frames follow.
+    pos = start + 4
+    while pos + 4 <= end:
+        f.seek(pos)
+        header = f.read(4)
+        pos += 4 + int.from_bytes(header[1:4], "big")
+        if header[0] & 0x80:
+            return [(pos, end)]
+    return None
+
+
+def _mp4_ranges(f, start, end):
+    # Top-level boxes; the audio is in "mdat", tags in "moov"/"udta".
+    ranges = []
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        size, kind = int.from_bytes(header[:4], "big"), header[4:8]
+        body = pos + 8
+        if size == 1:
+            size = int.from_bytes(f.read(8), "big")
+            body += 8
+        elif size == 0:
+            size = end - pos
+        if size < body - pos:
+            return None
+        if kind == b"mdat":
+            ranges.append((body, min(pos + size, end)))
+        pos += size
+    return ranges or None
+
+
+def _wave_ranges(f, start, end):
+    # RIFF chunks; the samples are in "data", tags in "LIST"/"id3 ".
+    pos = start + 12
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        size = int.from_bytes(header[4:8], "little")
+        if header[:4] == b"data":
+            return [(pos + 8, min(pos + 8 + size, end))]
+        pos += 8 + size + (size & 1)
+    return None
+
+
+# Header packets before the first audio page, by the identification
+# packet's signature: Vorbis has identification, comments and setup, Opus
+# identification and comments.
+OGG_HEADER_PACKETS = {b"\x01vorbis": 3, b"OpusHead": 2}
+
+
+def _ogg_ranges(f, start, end):
+    # Audio always starts on a fresh page after the header packets. Those
+    # pages keep their bodies when the comment packet is rewritten; only
+    # their sequence numbers and CRCs change.
+    ranges = []
+    headers = None
+    packets = 0
+    pos = start
+    while pos + 27 <= end:
+        f.seek(pos)
+        header = f.read(27)
+        if header[:4] != b"OggS":
+            return None
+        segments = f.read(header[26])
+        body = pos + 27 + len(segments)
+        pos = body + sum(segments)
+        if headers is None:
+            first = f.read(8)
+            headers = next((count for signature, count in OGG_HEADER_PACKETS.items()
+                            if first.startswith(signature)), None)
+            if headers is None:
+                return None
+        if packets >= headers:
+            ranges.append((body, min(pos, end)))
+        else:
+            packets += sum(1 for lacing in segments if lacing < 255)
+    return ranges or None
+
+
+def _audio_ranges(f, file_size):
+    """
+    Byte ranges holding the audio payload, with tags and other metadata
+    left out: leading ID3v2 and trailing ID3v1 tags, FLAC metadata blocks,
+    everything but "mdat" in MP4, Ogg header pages and non-data RIFF chunks.
+    """
+    start = _id3v2_size(f.read(10))
+    f.seek(start)
+    magic = f.read(12)
+    parsers = {b"fLaC": _flac_ranges, b"OggS": _ogg_ranges}
+    if magic[:4] in parsers:
+        ranges = parsers[magic[:4]](f, start, file_size)
+    elif magic[4:8] == b"ftyp":
+        ranges = _mp4_ranges(f, start, file_size)
+    elif magic[:4] == b"RIFF" and magic[8:12] == b"WAVE":
+        ranges = _wave_ranges(f, start, file_size)
+    else:
+        ranges = None
+    if ranges:
+        return ranges
+    end = file_size
+    if file_size - start >= ID3V1_SIZE:
+        f.seek(file_size - ID3V1_SIZE)
+        if f.read(3) == b"TAG":
+            end -= ID3V1_SIZE
+    return [(start, end)]
+
+
+def audio_hash(file_path, block_size=1024 * 1024):
+    """
+    SHA-256 of the audio payload. Tags and other container metadata are
+    skipped (see _audio_ranges) so retagging a file does not change its key.
+    """
+    file_size = os.path.getsize(file_path)
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for start, end in _audio_ranges(f, file_size):
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = f.read(min(block_size, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+    return digest.hexdigest()
+
+
+class RecognitionCache:
+    """
+    On-disk cache of Shazam results keyed by audio_hash().
+
+    Stores the raw track_data returned by Shazam together with the is_match
+    verdict at the time. The key ignores the file name, so callers re-check
+    a cached track against the current file instead of reusing the verdict;
+    it only decides expiry. Negative entries expire after
+    `negative_ttl_seconds`; all entries expire after `max_age_seconds` and
+    the least recently used ones are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, db_path=CACHE_DB):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS recognitions (
+                hash TEXT PRIMARY KEY,
+                matched INTEGER NOT NULL,
+                track_data TEXT,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS recognitions_accessed ON recognitions (accessed)")
+        self._conn.commit()
+
+    def get(self, content_hash):
+        """
+        Return (matched, track_data) for a cached result, or None on a miss.
+        `matched` is the verdict for the file the result was stored for.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT matched, track_data, created FROM recognitions WHERE hash = ?",
+                (content_hash,)).fetchone()
+            if row:
+                matched, track_data, created = row
+                ttl = max_age_seconds if matched else min(
+                    negative_ttl_seconds, max_age_seconds)
+                if now - created > ttl:
+                    self._conn.execute(
+                        "DELETE FROM recognitions WHERE hash = ?", (content_hash,))
+                    self._conn.commit()
+                    row = None
+                else:
+                    self._conn.execute(
+                        "UPDATE recognitions SET accessed = ? WHERE hash = ?", (now, content_hash))
+                    self._conn.commit()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return bool(matched), json.loads(track_data) if track_data else None
+
+    def put(self, content_hash, matched, track_data=None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO recognitions (hash, matched, track_data, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (content_hash, int(bool(matched)),
+                 json.dumps(track_data) if track_data else None, now, now))
+            self._conn.commit()
+
+    def evict(self):
+        """
+        Drop expired entries and trim the cache to `max_entries`.
+        Returns the number of rows removed.
+        """
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM recognitions WHERE created < ? OR (matched = 0 AND created < ?)",
+                (now - max_age_seconds, now - negative_ttl_seconds))
+            removed = cur.rowcount
+            cur = self._conn.execute(
+                "DELETE FROM recognitions WHERE hash IN ("
+                "SELECT hash FROM recognitions ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (max_entries,))
+            removed += cur.rowcount
+            self._conn.commit()
+        if removed:
+            log.info(f"Evicted {removed} entries from recognition cache")
+        return removed
+
+    def stats(self, reset=False):
+        """
+        Return (hits, misses) since the last reset.
+        """
+        with self._lock:
+            result = (self.hits, self.misses)
+            if reset:
+                self.hits = 0
+                self.misses = 0
+        return result
+
+
+recognition_cache = RecognitionCache()
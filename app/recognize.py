@@ -1,39 +1,62 @@
 import os
-import difflib
+import asyncio
 import logger as logger
-from utils import update_mp3_metadata
+from utils import update_metadata
 from notifier import send_slack_notification
+from catalog import catalog
+from cover_art import cover_cache
+from matching import matcher
+from metrics import metrics
 
 log = logger.logger
 
 
-def is_match(recognized_artist, recognized_title, file_name, threshold=0.7):
+def is_match(recognized_artist, recognized_title, file_name, threshold=0.7, use_tags=True):
     """
-    Validate recognized track info by comparing with the filename.
-    Expected file_name format: "ARTIST - TITLE.mp3"
-    Returns True if both artist and title comparisons meet the threshold.
+    Validate recognized track info against the local file: its name (in
+    "ARTIST - TITLE" or free form), existing tags unless `use_tags` is
+    False, or a known catalog song.
+    Returns True if the recognition belongs to the file. Reads tags and the
+    catalog, so async callers run it in a thread.
     """
-    base = os.path.splitext(os.path.basename(file_name))[0]
-    try:
-        file_artist, file_title = [x.strip().lower()
-                                   for x in base.split('-', 1)]
-    except ValueError:
-        log.debug(
-            f"Filename {file_name} is not in the expected 'ARTIST - TITLE' format.")
-        return False
+    return matcher.is_match(recognized_artist, recognized_title, file_name, threshold,
+                            use_tags=use_tags)
 
-    artist_ratio = difflib.SequenceMatcher(
-        None, recognized_artist.lower(), file_artist).ratio()
-    title_ratio = difflib.SequenceMatcher(
-        None, recognized_title.lower(), file_title).ratio()
-    log.debug(
-        f"Comparing with file name: artist_ratio={artist_ratio:.2f}, title_ratio={title_ratio:.2f}")
-    return artist_ratio >= threshold and title_ratio >= threshold
+
+async def accept_track(track_data, original_file):
+    """
+    Tag the file with the recognized track and record it in the song catalog.
+    """
+    recognized_artist = track_data.get("subtitle", "")
+    recognized_title = track_data.get("title", "")
+    cover_data = await cover_cache.get(track_data.get("images", {}).get("coverart"))
+    with metrics.timed("tagging"):
+        await asyncio.to_thread(update_metadata, original_file, title=recognized_title,
+                                artist=recognized_artist, cover_data=cover_data)
+    current_song = f"{recognized_artist} - {recognized_title}"
+    matcher.add(recognized_artist, recognized_title)
+    if catalog.record_track(track_data, source_file=original_file):
+        log.info(f"New song discovered: {current_song}")
+    else:
+        log.info(f"Duplicate song found: {current_song}")
 
 
-async def recognize(chunk_path, original_file, output_file, shazam):
+async def recognize(chunk, original_file, shazam, label=None):
+    """
+    Recognize a chunk and check the result against the file. Tagging is
+    left to the caller (accept_track) so it can be resumed on its own.
+    `chunk` is a file path or the audio bytes of a streamed window; `label`
+    names it in the logs.
+    Returns (matched, track_data); track_data is None when Shazam found nothing.
+    """
+    chunk_path = label or chunk
     log.debug(f"Recognizing chunk: {chunk_path}")
-    out = await shazam.recognize(chunk_path)
+    try:
+        with metrics.timed("recognize"):
+            out = await shazam.recognize(chunk)
+    except Exception:
+        metrics.inc("recognitions_total", result="error")
+        raise
     log.debug(f"Recognition result: {out}")
 
     if "track" in out:
@@ -43,26 +66,23 @@ async def recognize(chunk_path, original_file, output_file, shazam):
         log.debug(
             f"Track detected: {recognized_artist} - {recognized_title} for file: {original_file}")
 
-        # Send slack notification
-        send_slack_notification(
-            f"Recognized: {recognized_artist} - {recognized_title}")
-
         # Validate recognition by comparing with the local file name.
-        if not is_match(recognized_artist, recognized_title, original_file):
+        if not await asyncio.to_thread(is_match, recognized_artist, recognized_title, original_file):
             log.debug(
                 f"Validation failed: Recognized info does not sufficiently match the file name for {original_file}")
-            return False
+            send_slack_notification(
+                f"Rejected: {recognized_artist} - {recognized_title} for {os.path.basename(original_file)}",
+                kind="rejected")
+            metrics.inc("recognitions_total", result="rejected")
+            return False, track_data
 
-        update_mp3_metadata(original_file, track_data=track_data)
-        with open(output_file, "a+") as write_file:
-            current_song = f"{recognized_artist} - {recognized_title}"
-            write_file.seek(0)
-            if any(current_song == x.strip() for x in write_file):
-                log.info(f"Duplicate song found: {current_song}")
-            else:
-                log.info(f"New song discovered: {current_song}")
-                write_file.write(current_song + "\n")
-        return True
+        metrics.inc("recognitions_total", result="matched")
+
+        # Send slack notification
+        send_slack_notification(
+            f"Recognized: {recognized_artist} - {recognized_title}", kind="recognized")
+        return True, track_data
     else:
         log.debug(f"No track identified in chunk: {chunk_path}")
-    return False
+        metrics.inc("recognitions_total", result="no_match")
+    return False, None
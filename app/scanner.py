@@ -0,0 +1,239 @@
+import fnmatch
+import os
+import sqlite3
+import threading
+import time
+import logger as logger
+
+log = logger.logger
+
+SCAN_MANIFEST_DB = os.getenv("SCAN_MANIFEST_DB", os.path.join(
+    os.path.dirname(__file__), "..", "scan_manifest.db"))
+# Comma separated globs matched against the name or the path relative to
+# the scanned folder; excludes also prune folders.
+scan_include = os.getenv("SCAN_INCLUDE", "*")
+scan_exclude = os.getenv("SCAN_EXCLUDE", "")
+# Every Nth scan stats every file instead of trusting folder mtimes.
+scan_full_every = int(os.getenv("SCAN_FULL_EVERY", "12"))
+
+# A folder modified this recently is listed again even if its mtime matches
+# the manifest: coarse (NFS/SMB) timestamps can hide a change made in the
+# same tick as the previous scan.
+MTIME_SLACK_NS = 2 * 10**9
+
+
+def parse_globs(spec):
+    return [glob.strip() for glob in spec.split(",") if glob.strip()]
+
+
+class ScanResult:
+    def __init__(self, full=False):
+        self.full = full
+        self.changed = []
+        self.removed = []
+        self.folders = 0
+        self.folders_skipped = 0
+        self.files = 0
+        self.stats = 0
+        self.seconds = 0.0
+
+    def describe(self):
+        return (f"{'full' if self.full else 'incremental'} scan: "
+                f"{self.files} file(s) in {self.folders} folder(s) "
+                f"({self.folders_skipped} unchanged), {len(self.changed)} new/changed, "
+                f"{len(self.removed)} removed, {self.stats} stat(s), {self.seconds:.3f}s")
+
+
+class Scanner:
+    """
+    Incremental folder scanner for mounts where file events are unreliable.
+
+    A manifest of every file's (size, mtime, inode) and every folder's mtime
+    is kept in SQLite (or only in memory without `manifest_db`). A folder
+    whose mtime is unchanged has had no entries added, removed or renamed,
+    so it is not listed again and only its subfolders are checked. In a
+    listed folder, only files that are new or whose inode changed are
+    stat()ed. Writes to an existing file do not touch its folder's mtime,
+    which is why the first scan and every `full_every`th scan after it
+    stat everything. Each scan returns only the new or changed files.
+    """
+
+    def __init__(self, root, manifest_db=None, include=None, exclude=None, recursive=True,
+                 full_every=None):
+        self.root = os.path.abspath(root)
+        self.include = parse_globs(scan_include) if include is None else list(include)
+        self.exclude = parse_globs(scan_exclude) if exclude is None else list(exclude)
+        self.recursive = recursive
+        self.full_every = scan_full_every if full_every is None else full_every
+        self.scans = 0
+        self.last = None
+        self.files = {}    # path -> (size, mtime_ns, inode)
+        self.folders = {}  # path -> mtime_ns
+        self._lock = threading.Lock()
+        self._conn = None
+        if manifest_db:
+            self._conn = sqlite3.connect(manifest_db, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL
+                )""")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL)")
+            self._conn.commit()
+            prefix = self.root + os.sep
+            for path, size, mtime_ns, inode in self._conn.execute("SELECT * FROM files"):
+                if path.startswith(prefix):
+                    self.files[path] = (size, mtime_ns, inode)
+            for path, mtime_ns in self._conn.execute("SELECT * FROM folders"):
+                if path == self.root or path.startswith(prefix):
+                    self.folders[path] = mtime_ns
+        self._children = {}
+        for path in list(self.files) + list(self.folders):
+            if path != self.root:
+                self._children.setdefault(os.path.dirname(path), set()).add(path)
+
+    def _matches(self, globs, name, relative):
+        return any(fnmatch.fnmatch(name, glob) or fnmatch.fnmatch(relative, glob)
+                   for glob in globs)
+
+    def _wanted(self, path, is_folder):
+        name = os.path.basename(path)
+        if name.startswith("."):
+            # Hidden entries are temp outputs (ours or an uploader's).
+            return False
+        relative = os.path.relpath(path, self.root).replace(os.sep, "/")
+        if self._matches(self.exclude, name, relative):
+            return False
+        return is_folder or self._matches(self.include, name, relative)
+
+    def _forget(self, path, result):
+        """
+        Drop a file or a whole folder from the manifest.
+        """
+        for child in self._children.pop(path, ()):
+            self._forget(child, result)
+        if path in self.files:
+            del self.files[path]
+            result.removed.append(path)
+        self.folders.pop(path, None)
+        parent = self._children.get(os.path.dirname(path))
+        if parent is not None:
+            parent.discard(path)
+
+    def _list(self, folder, full, result):
+        """
+        List a changed folder: record its files and return its subfolders.
+        """
+        seen = set()
+        subfolders = []
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if self.recursive and self._wanted(entry.path, True):
+                        seen.add(entry.path)
+                        subfolders.append(entry.path)
+                    continue
+                if not entry.is_file() or not self._wanted(entry.path, False):
+                    continue
+                seen.add(entry.path)
+                known = self.files.get(entry.path)
+                if known is not None and known[2] == entry.inode() and not full:
+                    continue
+                st = entry.stat()
+                result.stats += 1
+                current = (st.st_size, st.st_mtime_ns, st.st_ino)
+                if current != known:
+                    self.files[entry.path] = current
+                    result.changed.append(entry.path)
+        for path in self._children.get(folder, set()) - seen:
+            self._forget(path, result)
+        self._children[folder] = seen
+        return subfolders
+
+    def scan(self, full=None):
+        """
+        Walk the tree and return a ScanResult with the new or changed files
+        (in `changed`) and the files that disappeared (in `removed`).
+        """
+        with self._lock:
+            return self._scan(full)
+
+    def _scan(self, full):
+        start = time.monotonic()
+        self.scans += 1
+        if full is None:
+            # The first scan of a process is full, so a manifest left by an
+            # earlier run is checked against the disk once.
+            full = self.scans == 1 or (self.full_every > 0
+                                       and self.scans % self.full_every == 1)
+        result = ScanResult(full)
+        old_folders = dict(self.folders)
+        recent = time.time_ns() - MTIME_SLACK_NS
+        stack = [self.root]
+        while stack:
+            folder = stack.pop()
+            try:
+                mtime_ns = os.stat(folder).st_mtime_ns
+            except FileNotFoundError:
+                self._forget(folder, result)
+                continue
+            except OSError as e:
+                log.warning(f"Cannot stat {folder}: {e}")
+                continue
+            result.stats += 1
+            result.folders += 1
+            unchanged = old_folders.get(folder) == mtime_ns and mtime_ns < recent
+            if unchanged and not full:
+                result.folders_skipped += 1
+                stack.extend(path for path in self._children.get(folder, ())
+                             if path in self.folders)
+                continue
+            try:
+                subfolders = self._list(folder, full, result)
+            except (FileNotFoundError, NotADirectoryError):
+                self._forget(folder, result)
+                continue
+            except OSError as e:
+                # Keep what the manifest knows and try again next scan.
+                log.warning(f"Cannot list {folder}: {e}")
+                continue
+            self.folders[folder] = mtime_ns
+            for path in subfolders:
+                self.folders.setdefault(path, None)
+            stack.extend(subfolders)
+        result.files = len(self.files)
+        self._save(result, old_folders)
+        result.seconds = time.monotonic() - start
+        self.last = result
+        return result
+
+    def _save(self, result, old_folders):
+        if self._conn is None:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)",
+                [(path, *self.files[path]) for path in result.changed])
+            self._conn.executemany(
+                "DELETE FROM files WHERE path = ?", [(path,) for path in result.removed])
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO folders (path, mtime_ns) VALUES (?, ?)",
+                [(path, mtime_ns) for path, mtime_ns in self.folders.items()
+                 if mtime_ns is not None and old_folders.get(path) != mtime_ns])
+            self._conn.executemany(
+                "DELETE FROM folders WHERE path = ?",
+                [(path,) for path in old_folders if path not in self.folders])
+
+    def present(self):
+        """
+        Every file currently in the manifest, without touching the disk.
+        """
+        with self._lock:
+            return sorted(self.files)
+
+    def describe(self):
+        return self.last.describe() if self.last else "not scanned yet"
@@ -0,0 +1,129 @@
+import os
+import threading
+from contextlib import contextmanager
+import paramiko
+import logger as logger
+
+log = logger.logger
+
+# Parallel SFTP channels opened over one authenticated connection.
+sftp_channels = int(os.getenv("SFTP_CHANNELS", "4"))
+# Seconds between SSH keepalive packets on idle connections.
+sftp_keepalive = int(os.getenv("SFTP_KEEPALIVE_SECONDS", "30"))
+
+
+class SFTPPool:
+    """
+    One authenticated SSH transport shared by up to `channels` SFTP sessions.
+
+    The handshake and authentication happen once; sessions are handed out
+    by session() and returned for reuse. A dropped transport is detected on
+    the next session() call and reconnected transparently. Remote directories
+    that have been checked or created are remembered for the life of the
+    connection.
+    """
+
+    def __init__(self, host, port, username, password, channels=None, keepalive=None):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.channels = channels or sftp_channels
+        self.keepalive = keepalive or sftp_keepalive
+        self.transport = None
+        self._idle = []
+        self._dirs = set()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.channels)
+
+    def _connect(self):
+        # Called with self._lock held.
+        if self.transport is not None and self.transport.is_active():
+            return self.transport
+        if self.transport is not None:
+            log.info(f"SFTP connection to {self.host} dropped, reconnecting")
+            self.transport.close()
+        log.debug(f"Opening SFTP connection to {self.host}:{self.port}")
+        transport = paramiko.Transport((self.host, self.port))
+        transport.set_keepalive(self.keepalive)
+        transport.connect(username=self.username, password=self.password)
+        self.transport = transport
+        self._idle = []
+        self._dirs = set()
+        return transport
+
+    def is_active(self):
+        return self.transport is not None and self.transport.is_active()
+
+    @contextmanager
+    def session(self):
+        """
+        Yield an SFTPClient. Sessions that raised are closed instead of being
+        returned to the pool.
+        """
+        with self._slots:
+            with self._lock:
+                transport = self._connect()
+                sftp = self._idle.pop() if self._idle else None
+            if sftp is None:
+                sftp = paramiko.SFTPClient.from_transport(transport)
+            try:
+                yield sftp
+            except Exception:
+                sftp.close()
+                raise
+            with self._lock:
+                if self.transport is transport and transport.is_active():
+                    self._idle.append(sftp)
+                else:
+                    sftp.close()
+
+    def ensure_dir(self, sftp, remote_directory):
+        """
+        Make sure the remote directory exists, checking each one only once.
+        """
+        if remote_directory in self._dirs:
+            return
+        try:
+            sftp.stat(remote_directory)
+        except IOError:
+            log.info(f"Creating remote directory {remote_directory}")
+            try:
+                sftp.mkdir(remote_directory)
+            except IOError:
+                # Another channel may have created it in the meantime.
+                sftp.stat(remote_directory)
+        self._dirs.add(remote_directory)
+
+    def close(self):
+        with self._lock:
+            for sftp in self._idle:
+                sftp.close()
+            self._idle = []
+            if self.transport is not None:
+                self.transport.close()
+                self.transport = None
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port, username, password):
+    """
+    Return the shared pool for these credentials, creating it on first use.
+    """
+    key = (host, int(port), username, password)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = SFTPPool(host, port, username, password)
+            _pools[key] = pool
+        return pool
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -1,86 +1,237 @@
+import hashlib
 import os
-import json
-import paramiko
+import posixpath
+import time
+from concurrent.futures import ThreadPoolExecutor
 import logger as logger
 from notifier import send_slack_notification
+from upload_ledger import upload_ledger, file_hash
+from sftp_pool import get_pool
+from metrics import metrics
 
 log = logger.logger
 
-TRACKER_JSON = os.path.join(os.path.dirname(
-    __file__), "..", "uploaded_files.json")
+# SFTP settings are read once at startup.
+sftp_username = os.environ.get("SFTP_USERNAME")
+sftp_host = os.environ.get("SFTP_HOST")
+sftp_password = os.environ.get("SFTP_PASSWORD")
+sftp_port = int(os.environ.get("SFTP_PORT", "2022"))
+sftp_remote_dir = os.environ.get("SFTP_REMOTE_DIR", "/upload")
+# Ask the server for a SHA-256 of the uploaded file before committing it.
+verify_checksum = os.environ.get(
+    "SFTP_VERIFY_CHECKSUM", "false").lower() == "true"
+TRANSFER_BLOCK_SIZE = 256 * 1024
 
 
-def load_tracker():
-    if os.path.exists(TRACKER_JSON):
-        with open(TRACKER_JSON, "r") as f:
-            try:
-                return json.load(f)
-            except Exception:
-                return {}
-    return {}
+def sftp_configured():
+    return bool(sftp_username and sftp_host and sftp_password)
 
 
-def save_tracker(data):
-    with open(TRACKER_JSON, "w") as f:
-        json.dump(data, f)
+class TransferVerificationError(Exception):
+    """
+    Raised when the remote copy does not match the local file.
+    """
+
+
+def transfer_file(sftp, file_path, remote_path, content_hash=None):
+    """
+    Upload to a hidden temp name next to remote_path, resuming from the
+    temp file's size if an earlier attempt was interrupted. The temp name
+    carries the file's content hash, and the bytes already on the server are
+    compared with the local file before resuming, so a stale or damaged
+    partial is restarted instead of completed. The remote size (and, on
+    resumed uploads or with SFTP_VERIFY_CHECKSUM, a server-side SHA-256 when
+    the server supports the check-file extension) is verified before the
+    temp file is renamed into place.
+    Returns (bytes_sent, seconds).
+    """
+    content_hash = content_hash or file_hash(file_path)
+    remote_dir, basename = posixpath.split(remote_path)
+    tmp_path = posixpath.join(remote_dir, f".{basename}.{content_hash[:16]}.part")
+    local_size = os.path.getsize(file_path)
+
+    try:
+        offset = sftp.stat(tmp_path).st_size
+    except IOError:
+        offset = 0
+    if offset > local_size:
+        log.warning(
+            f"Remote temp file {tmp_path} is larger than the local file, restarting upload")
+        offset = 0
+    if offset and not _prefix_matches(sftp, tmp_path, file_path, offset):
+        log.warning(
+            f"Remote temp file {tmp_path} does not match the local file, restarting upload")
+        offset = 0
+    if offset:
+        log.info(f"Resuming upload of {basename} at byte {offset}")
+
+    start = time.monotonic()
+    with open(file_path, "rb") as local, sftp.open(tmp_path, "r+" if offset else "w") as remote:
+        remote.set_pipelined(True)
+        local.seek(offset)
+        remote.seek(offset)
+        for block in iter(lambda: local.read(TRANSFER_BLOCK_SIZE), b""):
+            remote.write(block)
+    seconds = time.monotonic() - start
+
+    remote_size = sftp.stat(tmp_path).st_size
+    if remote_size != local_size:
+        raise TransferVerificationError(
+            f"size mismatch for {tmp_path}: remote {remote_size}, local {local_size}")
+    if verify_checksum or offset:
+        _verify_checksum(sftp, tmp_path, content_hash)
+
+    try:
+        sftp.posix_rename(tmp_path, remote_path)
+    except IOError:
+        # Server without the posix-rename extension: plain rename cannot
+        # overwrite, so remove any previous copy first.
+        try:
+            sftp.remove(remote_path)
+        except IOError:
+            pass
+        sftp.rename(tmp_path, remote_path)
+    return local_size - offset, seconds
+
+
+def _prefix_matches(sftp, remote_path, file_path, length):
+    """
+    True if the first `length` bytes of the remote file equal the local
+    file's. Uses a server-side SHA-256 when the server supports it, else
+    reads the remote bytes back.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as local:
+        remaining = length
+        while remaining:
+            block = local.read(min(TRANSFER_BLOCK_SIZE, remaining))
+            if not block:
+                return False
+            digest.update(block)
+            remaining -= len(block)
+    with sftp.open(remote_path, "r") as remote:
+        try:
+            return remote.check("sha256", 0, length, 0) == digest.digest()
+        except IOError:
+            log.debug("Server does not support checksums, comparing the partial upload by reading it back")
+        remote.prefetch(length)
+        remote_digest = hashlib.sha256()
+        remaining = length
+        while remaining:
+            block = remote.read(min(TRANSFER_BLOCK_SIZE, remaining))
+            if not block:
+                return False
+            remote_digest.update(block)
+            remaining -= len(block)
+    return remote_digest.digest() == digest.digest()
+
+
+def _verify_checksum(sftp, remote_path, content_hash):
+    try:
+        with sftp.open(remote_path, "r") as remote:
+            remote_hash = remote.check("sha256", 0, 0, 0).hex()
+    except IOError as e:
+        log.debug(
+            f"Server does not support checksums, verified size only: {e}")
+        return
+    if remote_hash != content_hash:
+        raise TransferVerificationError(
+            f"checksum mismatch for {remote_path}")
+
+
+def remote_path_for(remote_directory, basename, content_hash):
+    """
+    Remote path for a file. If the ledger shows different content was
+    already uploaded under the same name (two songs that sanitize to one
+    name), a short hash suffix keeps the earlier upload from being
+    overwritten.
+    """
+    remote_path = posixpath.join(remote_directory, basename)
+    uploaded = upload_ledger.hashes_at(remote_path)
+    if not uploaded or content_hash in uploaded:
+        return remote_path
+    stem, ext = os.path.splitext(basename)
+    suffixed = posixpath.join(remote_directory, f"{stem}.{content_hash[:8]}{ext}")
+    log.warning(
+        f"{remote_path} already holds different content, uploading {basename} as {suffixed}")
+    return suffixed
 
 
 def upload_file_sftp(file_path, username, host, password, port, remote_directory):
     """
-    Connect to the SFTP server and upload a single file.
-    If upload is successful, add the file (by its basename) to the tracker.
+    Upload a single file over a pooled SFTP session.
+    If upload is successful, record it in the upload ledger by content hash
+    and remote path.
     """
     port = int(port)
-    tracker = load_tracker()
     basename = os.path.basename(file_path)
-    if basename in tracker:
+    content_hash = file_hash(file_path)
+    remote_path = remote_path_for(remote_directory, basename, content_hash)
+    if upload_ledger.is_uploaded(content_hash, remote_path):
+        log.info(
+            f"File {basename} already uploaded to {remote_path}. Deleting local copy.")
+        os.remove(file_path)
+        metrics.inc("uploads_total", result="skipped")
+        return True
+    if upload_ledger.is_legacy_uploaded(basename):
         log.info(f"File {basename} already uploaded. Skipping SFTP upload.")
+        metrics.inc("uploads_total", result="skipped")
         return True
 
+    pool = get_pool(host, port, username, password)
     try:
-        transport = paramiko.Transport((host, port))
-        transport.connect(username=username, password=password)
-        sftp = paramiko.SFTPClient.from_transport(transport)
+        with metrics.timed("upload"), pool.session() as sftp:
+            # Ensure remote directory exists.
+            pool.ensure_dir(sftp, remote_directory)
+            log.info(f"Uploading {file_path} to {remote_path}")
+            sent, seconds = transfer_file(
+                sftp, file_path, remote_path, content_hash)
 
-        # Ensure remote directory exists.
-        try:
-            sftp.chdir(remote_directory)
-        except IOError:
-            sftp.mkdir(remote_directory)
-            sftp.chdir(remote_directory)
-
-        remote_path = os.path.join(remote_directory, basename)
-        log.info(f"Uploading {file_path} to {remote_path}")
-        sftp.put(file_path, remote_path)
-        sftp.close()
-        transport.close()
-
-        # Update tracker and delete the local file.
-        tracker[basename] = True
-        save_tracker(tracker)
-        log.info(f"Upload succeeded for {basename}. Deleting local file.")
+        # Record the upload and delete the local file.
+        upload_ledger.record(content_hash, remote_path,
+                             file_path, transfer_seconds=seconds)
+        log.info(
+            f"Upload succeeded for {basename}: {sent / 1048576:.1f} MiB in {seconds:.1f}s "
+            f"({sent / 1048576 / max(seconds, 1e-6):.2f} MiB/s). Deleting local file.")
         os.remove(file_path)
+        metrics.inc("uploads_total", result="success")
+        metrics.inc("upload_bytes_total", sent)
         send_slack_notification(
-            f"Uploaded and deleted {basename} from processed files.")
+            f"Uploaded and deleted {basename} from processed files.", kind="uploaded")
         return True
     except Exception as e:
         log.error(f"SFTP upload failed for {basename}: {e}")
-        send_slack_notification(f"SFTP upload failed for {basename}: {e}")
+        metrics.inc("uploads_total", result="failed")
+        send_slack_notification(
+            f"SFTP upload failed for {basename}: {e}", kind="failed")
         return False
 
 
-if __name__ == "__main__":
-    # For testing, retrieve credentials from env vars.
-    sftp_username = os.environ.get("SFTP_USERNAME")
-    sftp_host = os.environ.get("SFTP_HOST")
-    sftp_password = os.environ.get("SFTP_PASSWORD")
-    sftp_port = int(os.environ.get("SFTP_PORT", "22"))
-    sftp_remote_dir = os.environ.get("SFTP_REMOTE_DIR", "/upload")
+def upload_files_sftp(file_paths, username=None, host=None, password=None, port=None, remote_directory=None):
+    """
+    Upload a batch of files in parallel over the pool's SFTP channels.
+    Credentials default to the SFTP_* environment settings.
+    Returns a dict of file path -> upload success.
+    """
+    username = username or sftp_username
+    host = host or sftp_host
+    password = password or sftp_password
+    port = port or sftp_port
+    remote_directory = remote_directory or sftp_remote_dir
+    pool = get_pool(host, port, username, password)
+    with ThreadPoolExecutor(max_workers=pool.channels) as executor:
+        results = executor.map(
+            lambda path: upload_file_sftp(
+                path, username, host, password, port, remote_directory),
+            file_paths)
+        return dict(zip(file_paths, results))
 
+
+if __name__ == "__main__":
     # Example file path—adjust as needed.
     test_file = os.path.join(os.path.dirname(
         __file__), "..", "processed_songs", "example.mp3")
-    if not (sftp_username and sftp_host and sftp_password):
+    if not sftp_configured():
         log.error("SFTP credentials not set in environment.")
     else:
         upload_file_sftp(test_file, sftp_username, sftp_host,
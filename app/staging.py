@@ -0,0 +1,148 @@
+import errno
+import os
+import shutil
+import logger as logger
+from metrics import metrics
+
+log = logger.logger
+
+# Recognized files are renamed into <input>/.staging/<key>/ (or STAGING_DIR,
+# which should be on the input volume so that handoff is a rename).
+staging_dir = os.getenv("STAGING_DIR", "")
+# Upload recognized files straight from staging; only files whose upload is
+# disabled or fails are moved into the processed folder.
+upload_from_staging = os.getenv("UPLOAD_FROM_STAGING", "false").lower() == "true"
+
+COPY_CHUNK = 8 * 1024 * 1024
+# copy_file_range refuses some pairs of filesystems; sendfile takes over.
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}
+
+
+def staging_folder(path_to_dir):
+    return staging_dir or os.path.join(path_to_dir, ".staging")
+
+
+def stage_path(path_to_dir, key, file_name):
+    """
+    Where a recognized file waits for its upload. Files are grouped by job
+    key so recover() can tell which ones an instance is still working on.
+    """
+    return os.path.join(staging_folder(path_to_dir), key, file_name)
+
+
+def _fsync_dir(folder):
+    fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _copy_data(fd_in, fd_out, size):
+    """
+    Copy `size` bytes between two file descriptors inside the kernel:
+    copy_file_range (which can reflink or copy server side), else sendfile,
+    else pread/pwrite. Returns the number of bytes copied.
+    """
+    methods = [name for name in ("copy_file_range", "sendfile") if hasattr(os, name)]
+    methods.append("pwrite")
+    offset = 0
+    while offset < size:
+        count = min(COPY_CHUNK, size - offset)
+        try:
+            if methods[0] == "copy_file_range":
+                sent = os.copy_file_range(fd_in, fd_out, count, offset, offset)
+            elif methods[0] == "sendfile":
+                # sendfile writes at the output's file position.
+                os.lseek(fd_out, offset, os.SEEK_SET)
+                sent = os.sendfile(fd_out, fd_in, offset, count)
+            else:
+                sent = os.pwrite(fd_out, os.pread(fd_in, count, offset), offset)
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS or len(methods) == 1:
+                raise
+            methods.pop(0)
+            continue
+        if not sent:
+            break
+        offset += sent
+    return offset
+
+
+def move(src, dst):
+    """
+    Move a file, replacing `dst`. On the same filesystem this is a rename.
+    Across devices the data is copied in the kernel to a hidden temp name,
+    fsynced with its folder, renamed into place, and only then is `src`
+    deleted, so a crash leaves either the source or a complete copy.
+    Returns `dst`.
+    """
+    try:
+        os.replace(src, dst)
+        metrics.inc("moves_total", method="rename")
+        return dst
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    folder, name = os.path.split(dst)
+    tmp_path = os.path.join(folder, f".{name}.part")
+    try:
+        with open(src, "rb") as fsrc, open(tmp_path, "wb") as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = _copy_data(fsrc.fileno(), fdst.fileno(), size)
+            if copied != size:
+                raise OSError(f"copied {copied} of {size} bytes from {src}")
+            os.fsync(fdst.fileno())
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dst)
+        _fsync_dir(folder or ".")
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.remove(src)
+    metrics.inc("moves_total", method="copy")
+    return dst
+
+
+def unstage(path, processed_folder):
+    """
+    Move a staged file into the processed folder (for upload_pending to
+    retry) and drop its key folder once empty. Returns the new path.
+    """
+    dest_path = move(path, os.path.join(processed_folder, os.path.basename(path)))
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+    return dest_path
+
+
+def recover(path_to_dir, processed_folder, in_use=None):
+    """
+    Unstage files an interrupted run left in staging. `in_use(key)` protects
+    files another instance is still uploading. Returns [(old, new), ...].
+    """
+    folder = staging_folder(path_to_dir)
+    moved = []
+    try:
+        with os.scandir(folder) as it:
+            keys = [entry for entry in it if entry.is_dir()]
+    except FileNotFoundError:
+        return moved
+    for key in keys:
+        if in_use is not None and in_use(key.name):
+            continue
+        with os.scandir(key.path) as it:
+            paths = [entry.path for entry in it
+                     if entry.is_file() and not entry.name.startswith(".")]
+        for path in paths:
+            try:
+                moved.append((path, unstage(path, processed_folder)))
+            except OSError as e:
+                log.warning(f"Could not unstage {path}: {e}")
+        try:
+            os.rmdir(key.path)
+        except OSError:
+            pass
+    return moved
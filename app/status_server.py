@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+import logger as logger
+from metrics import metrics
+
+log = logger.logger
+
+# Port for /metrics (Prometheus) and /status (JSON); 0 disables the server.
+status_port = int(os.getenv("STATUS_PORT", "9090"))
+status_host = os.getenv("STATUS_HOST", "0.0.0.0")
+# Clients that don't send a full request within this time are dropped.
+request_timeout = 5
+
+REASONS = {200: "OK", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    # Headers are not needed; read up to the blank line that ends them.
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+    parts = request_line.decode("latin-1").split()
+    if len(parts) < 2:
+        return None, None
+    return parts[0].upper(), parts[1].split("?", 1)[0]
+
+
+async def _handle(reader, writer):
+    try:
+        method, path = await asyncio.wait_for(_read_request(reader), request_timeout)
+        content_type = "text/plain; charset=utf-8"
+        if method not in ("GET", "HEAD"):
+            status, body = 405, "Method not allowed\n"
+        elif path == "/metrics":
+            # Gauges may list directories; keep that off the event loop.
+            status, body = 200, await asyncio.to_thread(metrics.render)
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path in ("/", "/status"):
+            snapshot = await asyncio.to_thread(metrics.snapshot)
+            status, body = 200, json.dumps(snapshot, indent=2) + "\n"
+            content_type = "application/json"
+        else:
+            status, body = 404, "Not found\n"
+        payload = body.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1"))
+        if method != "HEAD":
+            writer.write(payload)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    except Exception as e:
+        log.error(f"Status request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def start_status_server(host=None, port=None):
+    """
+    Serve /metrics and /status from the running event loop. Returns the
+    asyncio server, or None when disabled or the port is unavailable.
+    """
+    host = host or status_host
+    port = status_port if port is None else port
+    if not port:
+        log.info("Status server disabled (STATUS_PORT=0)")
+        return None
+    try:
+        server = await asyncio.start_server(_handle, host, port)
+    except OSError as e:
+        log.error(f"Could not start status server on {host}:{port}: {e}")
+        return None
+    log.info(f"Serving /metrics and /status on {host}:{port}")
+    return server
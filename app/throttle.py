@@ -0,0 +1,258 @@
+import asyncio
+import os
+import sqlite3
+import time
+import aiohttp
+from shazamio.exceptions import FailedDecodeJson
+import logger as logger
+
+log = logger.logger
+
+# Requests per second allowed towards Shazam, shared by all workers.
+shazam_rate = float(os.getenv("SHAZAM_RATE", "1"))
+# Upper bound for concurrent recognize() calls; the live limit moves
+# between 1 and this value.
+shazam_max_concurrency = int(os.getenv("SHAZAM_MAX_CONCURRENCY", "4"))
+# Consecutive failures that open the circuit, and how long it stays open.
+breaker_threshold = int(os.getenv("SHAZAM_BREAKER_THRESHOLD", "5"))
+breaker_cooldown = float(os.getenv("SHAZAM_BREAKER_COOLDOWN", "60"))
+# SQLite file shared by every instance on the host (a local volume, not
+# NFS) so they split one SHAZAM_RATE budget; unset keeps it per instance.
+shazam_rate_db = os.getenv("SHAZAM_RATE_DB")
+# Attempts per recognize() call before the error is raised to the caller.
+shazam_attempts = int(os.getenv("SHAZAM_ATTEMPTS", "3"))
+
+
+class ShazamUnavailable(Exception):
+    """
+    Raised when Shazam keeps failing and the file should be retried later.
+    """
+
+
+class ShazamUnavailableTransient(ShazamUnavailable):
+    """
+    An error response worth retrying (rate limited or a server error).
+    """
+
+
+# Network failures, timeouts, non-JSON replies (error pages) and retryable
+# error responses; anything else is raised to the caller at once.
+TRANSIENT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError, FailedDecodeJson,
+                    ShazamUnavailableTransient)
+
+
+def _error_status(errors):
+    """
+    HTTP status of a Shazam JSON error response, or None if it has none.
+    """
+    for error in errors if isinstance(errors, list) else [errors]:
+        status = error.get("status") if isinstance(error, dict) else None
+        if str(status).isdigit():
+            return int(status)
+    return None
+
+
+class RateLimiter:
+    """
+    Token bucket: allows `rate` acquisitions per second with a burst of one.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + 1.0 / self.rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class SharedRateLimiter:
+    """
+    RateLimiter whose schedule lives in SQLite, so every process using the
+    same file shares one budget of `rate` acquisitions per second.
+
+    Each acquisition reserves the next free slot inside an IMMEDIATE
+    transaction (serialized across processes) and then sleeps until it.
+    Slots use wall-clock time since monotonic clocks differ per process.
+    """
+
+    def __init__(self, rate, db_path):
+        self.rate = rate
+        self.db_path = db_path
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_budget (name TEXT PRIMARY KEY, next_slot REAL NOT NULL)")
+        conn.execute(
+            "INSERT OR IGNORE INTO rate_budget (name, next_slot) VALUES ('shazam', 0)")
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def _reserve(self):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            next_slot = conn.execute(
+                "SELECT next_slot FROM rate_budget WHERE name = 'shazam'").fetchone()[0]
+            now = time.time()
+            slot = max(now, next_slot)
+            conn.execute("UPDATE rate_budget SET next_slot = ? WHERE name = 'shazam'",
+                         (slot + 1.0 / self.rate,))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return slot - now
+
+    async def acquire(self):
+        wait = await asyncio.to_thread(self._reserve)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class ShazamThrottle:
+    """
+    Shared gate for every Shazam call: a rate limiter, an AIMD concurrency
+    limit and a circuit breaker.
+
+    Each success adds 1/limit to the concurrency limit (so it grows by one
+    per round of successful calls); each failure halves it. After
+    `breaker_threshold` consecutive failures the breaker opens and callers
+    wait for the cooldown, then a single probe call decides whether it closes.
+    """
+
+    def __init__(self, rate=None, max_concurrency=None, threshold=None, cooldown=None,
+                 rate_db=None):
+        rate_db = rate_db or shazam_rate_db
+        if rate_db:
+            self.limiter = SharedRateLimiter(rate or shazam_rate, rate_db)
+        else:
+            self.limiter = RateLimiter(rate or shazam_rate)
+        self.max_concurrency = max_concurrency or shazam_max_concurrency
+        self.threshold = threshold or breaker_threshold
+        self.cooldown = cooldown or breaker_cooldown
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.half_open = False
+        self._cond = asyncio.Condition()
+
+    @property
+    def state(self):
+        if self.half_open:
+            return "half-open"
+        if time.monotonic() < self.open_until:
+            return "open"
+        return "closed"
+
+    def describe(self):
+        shared = " (shared)" if isinstance(self.limiter, SharedRateLimiter) else ""
+        return (f"rate={self.limiter.rate:g}/s{shared} concurrency={int(self.limit)}/{self.max_concurrency} "
+                f"in_flight={self.in_flight} breaker={self.state}")
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                remaining = self.open_until - time.monotonic()
+                if remaining > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.failures >= self.threshold:
+                    # Cooldown elapsed: let exactly one probe call through.
+                    if self.half_open or self.in_flight:
+                        await self._cond.wait()
+                        continue
+                    self.half_open = True
+                    log.info("Shazam circuit breaker half-open, probing")
+                elif self.in_flight >= int(self.limit):
+                    await self._cond.wait()
+                    continue
+                self.in_flight += 1
+                break
+        try:
+            await self.limiter.acquire()
+        except BaseException:
+            await self.release(None)
+            raise
+
+    async def release(self, success):
+        """
+        Free the slot taken by acquire(). `success` feeds the concurrency
+        limit and the breaker; None (cancelled, or an error that says
+        nothing about Shazam's health) only frees the slot.
+        """
+        # The slot is freed before waiting for the condition, so it is not
+        # lost if the caller is cancelled while waiting.
+        self.in_flight -= 1
+        old_limit = int(self.limit)
+        if success:
+            if self.failures >= self.threshold:
+                log.info("Shazam circuit breaker closed")
+            self.failures = 0
+            self.limit = min(self.max_concurrency,
+                             self.limit + 1.0 / self.limit)
+        elif success is not None:
+            self.failures += 1
+            self.limit = max(1.0, self.limit / 2)
+            if self.failures >= self.threshold:
+                self.open_until = time.monotonic() + self.cooldown
+                log.warning(
+                    f"Shazam circuit breaker open for {self.cooldown:g}s after {self.failures} failures")
+        self.half_open = False
+        if int(self.limit) != old_limit:
+            log.info(f"Shazam throttle adjusted: {self.describe()}")
+        async with self._cond:
+            self._cond.notify_all()
+
+
+class ThrottledShazam:
+    """
+    Wrap a shazamio.Shazam so every recognize() goes through the throttle.
+    Transient errors (network, timeouts, rate limiting and server errors)
+    count as failures and are retried; the last one is raised as
+    ShazamUnavailable so the file is left in place for a later attempt.
+    Other errors are raised at once without retrying.
+    """
+
+    def __init__(self, shazam, throttle, attempts=None):
+        self.shazam = shazam
+        self.throttle = throttle
+        self.attempts = attempts or shazam_attempts
+
+    async def recognize(self, data):
+        last_error = None
+        for attempt in range(1, self.attempts + 1):
+            await self.throttle.acquire()
+            success = None
+            try:
+                out = await self.shazam.recognize(data)
+                if isinstance(out, dict) and ("errors" in out or "error" in out):
+                    # Throttling and service errors come back as JSON errors.
+                    errors = out.get("errors") or out.get("error")
+                    status = _error_status(errors)
+                    if status is None or status == 429 or status >= 500:
+                        raise ShazamUnavailableTransient(errors)
+                    raise ShazamUnavailable(errors)
+                success = True
+                return out
+            except TRANSIENT_ERRORS as e:
+                success = False
+                last_error = e
+                log.warning(
+                    f"Shazam request failed (attempt {attempt}/{self.attempts}): {e}")
+            finally:
+                await self.throttle.release(success)
+            if attempt < self.attempts:
+                await asyncio.sleep(min(30, 2 ** attempt))
+        raise ShazamUnavailable(str(last_error))
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import os
+from mutagen.id3 import ID3, ID3NoHeaderError, CHAP, CTOC, CTOCFlags, COMM, TIT2, TPE1
+import logger as logger
+from utils import decode_mono_pcm, pcm_to_wav, update_metadata, PROBE_SAMPLE_RATE
+from media_info import media_duration
+from throttle import ShazamUnavailable
+from notifier import send_slack_notification
+from catalog import catalog
+from matching import matcher
+from metrics import metrics
+
+log = logger.logger
+
+# Files at least this long are treated as DJ mixes and get a tracklist
+# instead of a single title; 0 disables mix mode.
+mix_min_duration = float(os.getenv("MIX_MIN_DURATION_MINUTES", "20")) * 60
+# A window of MIX_WINDOW_SECONDS is recognized every MIX_WINDOW_STEP_SECONDS.
+mix_window_step = float(os.getenv("MIX_WINDOW_STEP_SECONDS", "60"))
+mix_window_seconds = float(os.getenv("MIX_WINDOW_SECONDS", "20"))
+# Windows decoded and in flight at once; Shazam calls are still bounded by
+# the shared throttle.
+mix_concurrency = int(os.getenv("MIX_CONCURRENCY", "4"))
+
+# Up to this many unrecognized windows between two hits are split between
+# the neighbouring tracks; a longer run becomes an unidentified segment.
+MAX_GAP_WINDOWS = 2
+CUE_FRAMES_PER_SECOND = 75
+
+
+def is_mix(file_path):
+    """
+    True if the file is long enough to be processed as a mix.
+    """
+    if mix_min_duration <= 0:
+        return False
+    duration = media_duration(file_path)
+    return duration is not None and duration >= mix_min_duration
+
+
+def window_offsets(total_sec, step=None, window=None):
+    step = step or mix_window_step
+    window = window or mix_window_seconds
+    count = int(max(0.0, total_sec - window) // step) + 1
+    return [round(index * step, 2) for index in range(count)]
+
+
+async def recognize_window(file_path, offset, shazam):
+    """
+    Seek to `offset`, decode one window and send it to Shazam.
+    Returns a compact track dict, or None if nothing was identified.
+    """
+    pcm = await asyncio.to_thread(decode_mono_pcm, file_path, offset, mix_window_seconds,
+                                  PROBE_SAMPLE_RATE)
+    if not pcm:
+        return None
+    try:
+        with metrics.timed("recognize"):
+            out = await shazam.recognize(pcm_to_wav(pcm, PROBE_SAMPLE_RATE))
+    except Exception:
+        metrics.inc("recognitions_total", result="error")
+        raise
+    track = out.get("track") if isinstance(out, dict) else None
+    if not track:
+        metrics.inc("recognitions_total", result="no_match")
+        return None
+    metrics.inc("recognitions_total", result="matched")
+    return {"key": track.get("key"), "artist": track.get("subtitle", ""),
+            "title": track.get("title", "")}
+
+
+def _same_track(a, b):
+    if a["key"] and b["key"]:
+        return a["key"] == b["key"]
+    return (a["artist"], a["title"]) == (b["artist"], b["title"])
+
+
+def build_tracklist(hits, total_sec, step=None, window=None):
+    """
+    Merge per-window results [(offset, track or None), ...] into segments.
+
+    Consecutive hits of the same track form one segment, across short runs
+    of unrecognized windows; a single stray hit between two hits of the same
+    track is treated as a misrecognition. Boundaries between tracks are put
+    in the middle of the unheard audio between their windows. Longer gaps
+    become segments without a track. Confidence is the share of a
+    segment's windows that recognized its track.
+    """
+    step = step or mix_window_step
+    window = window or mix_window_seconds
+    runs = []
+    for offset, track in sorted(hits, key=lambda hit: hit[0]):
+        if track is None:
+            continue
+        if runs and _same_track(runs[-1]["track"], track):
+            runs[-1]["last"] = offset
+            runs[-1]["hits"] += 1
+        else:
+            runs.append({"track": track, "first": offset, "last": offset, "hits": 1})
+    index = 1
+    while index < len(runs) - 1:
+        before, stray, after = runs[index - 1], runs[index], runs[index + 1]
+        if stray["hits"] == 1 and _same_track(before["track"], after["track"]):
+            before["last"] = after["last"]
+            before["hits"] += after["hits"]
+            del runs[index:index + 2]
+        else:
+            index += 1
+
+    half_gap = max(step - window, 0.0) / 2
+
+    def gap_windows(start, end):
+        return round((end - start) / step) - 1
+
+    segments = []
+    previous_last = None
+    for run in runs:
+        gap = gap_windows(previous_last, run["first"]) if previous_last is not None \
+            else round(run["first"] / step)
+        if gap > MAX_GAP_WINDOWS:
+            start = max(0.0, run["first"] - half_gap)
+            if segments:
+                segments[-1]["end"] = previous_last + window + half_gap
+            segments.append({"start": segments[-1]["end"] if segments else 0.0,
+                             "end": start, "artist": None, "title": None, "key": None,
+                             "confidence": 0.0})
+        elif segments:
+            start = (previous_last + window + run["first"]) / 2
+            segments[-1]["end"] = start
+        else:
+            start = 0.0
+        span = gap_windows(run["first"], run["last"]) + 2
+        track = run["track"]
+        segments.append({"start": start, "end": None, "artist": track["artist"],
+                         "title": track["title"], "key": track["key"],
+                         "confidence": round(run["hits"] / span, 2)})
+        previous_last = run["last"]
+    if segments:
+        last_window = window_offsets(total_sec, step, window)[-1]
+        if gap_windows(previous_last, last_window) + 1 > MAX_GAP_WINDOWS:
+            segments[-1]["end"] = previous_last + window + half_gap
+            segments.append({"start": segments[-1]["end"], "end": total_sec, "artist": None,
+                             "title": None, "key": None, "confidence": 0.0})
+        else:
+            segments[-1]["end"] = total_sec
+    for segment in segments:
+        segment["start"] = round(min(segment["start"], total_sec), 2)
+        segment["end"] = round(min(segment["end"], total_sec), 2)
+    return [segment for segment in segments if segment["end"] > segment["start"]]
+
+
+async def recognize_mix(file, file_path, shazam):
+    """
+    Recognize windows across the whole mix concurrently and merge them into
+    a tracklist. Returns (recognized, track_data) like recognize_file, with
+    the segments in track_data["tracklist"].
+    """
+    total_sec = media_duration(file_path)
+    offsets = window_offsets(total_sec)
+    log.info(f"Mix mode for {file}: {len(offsets)} window(s) over {total_sec / 60:.0f} min")
+    semaphore = asyncio.Semaphore(mix_concurrency)
+
+    async def probe(offset):
+        async with semaphore:
+            try:
+                return offset, await recognize_window(file_path, offset, shazam)
+            except Exception as e:
+                log.warning(f"Window at {offset:g}s of {file} failed: {e}")
+                return offset, e
+
+    results = await asyncio.gather(*(probe(offset) for offset in offsets))
+    failed = sum(1 for _, result in results if isinstance(result, Exception))
+    if failed * 2 > len(results):
+        # Mostly errors: retry the whole file later instead of keeping a
+        # tracklist full of holes.
+        raise ShazamUnavailable(f"{failed} of {len(results)} windows failed")
+    hits = [(offset, None if isinstance(result, Exception) else result)
+            for offset, result in results]
+    tracklist = build_tracklist(hits, total_sec)
+    identified = [segment for segment in tracklist if segment["title"] is not None]
+    log.info(f"Identified {len(identified)} track(s) in mix {file}")
+    track_data = {"title": os.path.splitext(file)[0], "subtitle": "", "duration": total_sec,
+                  "window_step": mix_window_step, "tracklist": tracklist}
+    return bool(identified), track_data
+
+
+def format_timestamp(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+
+def _describe(segment):
+    if segment["title"] is None:
+        return "ID - ID"
+    return f"{segment['artist']} - {segment['title']}"
+
+
+def tracklist_text(tracklist):
+    return "\n".join(f"{format_timestamp(segment['start'])} {_describe(segment)}"
+                     for segment in tracklist)
+
+
+def _cue_quote(text):
+    return (text or "").replace('"', "'")
+
+
+def cue_sheet(audio_file, track_data):
+    """
+    Render a cue sheet for the mix; INDEX times are MM:SS:FF (75 frames/s).
+    """
+    # Cue sheets only know MP3 and WAVE; players use WAVE for any other format.
+    file_type = "MP3" if audio_file.lower().endswith(".mp3") else "WAVE"
+    lines = [f'TITLE "{_cue_quote(track_data["title"])}"',
+             f'FILE "{_cue_quote(os.path.basename(audio_file))}" {file_type}']
+    for number, segment in enumerate(track_data["tracklist"], 1):
+        frames = int(round(segment["start"] * CUE_FRAMES_PER_SECOND))
+        seconds, frame = divmod(frames, CUE_FRAMES_PER_SECOND)
+        lines += [f"  TRACK {number:02d} AUDIO",
+                  f'    TITLE "{_cue_quote(segment["title"] or "ID")}"',
+                  f'    PERFORMER "{_cue_quote(segment["artist"] or "ID")}"',
+                  f"    INDEX 01 {seconds // 60:02d}:{seconds % 60:02d}:{frame:02d}"]
+    return "\n".join(lines) + "\n"
+
+
+def sidecar_paths(audio_file):
+    base = os.path.splitext(audio_file)[0]
+    return base + ".cue", base + ".tracklist.json"
+
+
+def write_sidecars(audio_file, track_data):
+    """
+    Write <name>.cue and <name>.tracklist.json next to the audio file.
+    Returns their paths.
+    """
+    cue_path, json_path = sidecar_paths(audio_file)
+    with open(cue_path, "w", encoding="utf-8") as f:
+        f.write(cue_sheet(audio_file, track_data))
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump({"file": os.path.basename(audio_file), "duration": track_data["duration"],
+                   "window_step": track_data["window_step"],
+                   "tracks": track_data["tracklist"]}, f, ensure_ascii=False, indent=2)
+    return [cue_path, json_path]
+
+
+def write_chapters(file_path, track_data):
+    """
+    Store the tracklist in the file's ID3 tag: one CHAP frame per segment
+    under a CTOC table of contents, plus a COMM frame with the text list.
+    """
+    try:
+        audio = ID3(file_path)
+    except ID3NoHeaderError:
+        audio = ID3()
+    for frame_id in ("CHAP", "CTOC"):
+        audio.delall(frame_id)
+    audio.setall("TIT2", [TIT2(encoding=3, text=track_data["title"])])
+    child_ids = []
+    for number, segment in enumerate(track_data["tracklist"]):
+        element_id = f"chp{number}"
+        child_ids.append(element_id)
+        audio.add(CHAP(element_id=element_id, start_time=int(segment["start"] * 1000),
+                       end_time=int(segment["end"] * 1000),
+                       sub_frames=[TIT2(encoding=3, text=_describe(segment)),
+                                   TPE1(encoding=3, text=segment["artist"] or "ID")]))
+    audio.add(CTOC(element_id="toc", flags=CTOCFlags.TOP_LEVEL | CTOCFlags.ORDERED,
+                   child_element_ids=child_ids,
+                   sub_frames=[TIT2(encoding=3, text="Tracklist")]))
+    audio.add(COMM(encoding=3, lang="eng", desc="Tracklist",
+                   text=tracklist_text(track_data["tracklist"])))
+    audio.save(file_path, v2_version=3)
+
+
+async def accept_mix(track_data, original_file):
+    """
+    Tag the mix with its tracklist and record each identified track in the
+    song catalog. Chapters need ID3; other formats get the tracklist as a
+    comment (the cue sheet has the timings).
+    """
+    with metrics.timed("tagging"):
+        if original_file.lower().endswith(".mp3"):
+            await asyncio.to_thread(write_chapters, original_file, track_data)
+        else:
+            await asyncio.to_thread(update_metadata, original_file, title=track_data["title"],
+                                    artist="", comment=tracklist_text(track_data["tracklist"]))
+    identified = [segment for segment in track_data["tracklist"] if segment["title"] is not None]
+    for segment in identified:
+        matcher.add(segment["artist"], segment["title"])
+        catalog.record(segment["artist"], segment["title"],
+                       source_file=os.path.basename(original_file), shazam_key=segment["key"])
+    send_slack_notification(
+        f"Tracklist: {len(identified)} track(s) identified in {os.path.basename(original_file)}",
+        kind="recognized")
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import subprocess
+from logger import logger
+from media_info import media_info
+
+# Format recognized files are delivered in: mp3, aac, opus, vorbis, flac,
+# or "original" to keep every file as it arrived.
+target_codec = os.getenv("TARGET_CODEC", "mp3").lower()
+# Encoder bitrate such as "320k"; empty uses the encoder's default.
+target_bitrate = os.getenv("TARGET_BITRATE", "")
+
+# Transcodes allowed to run at once, and how long one may take.
+convert_workers = int(os.getenv("CONVERT_WORKERS", str(os.cpu_count() or 1)))
+convert_timeout = float(os.getenv("CONVERT_TIMEOUT_SECONDS", "1800"))
+
+# encoder, file extension, ffmpeg muxer and the codec names ffprobe reports.
+TARGETS = {
+    "mp3": {"encoder": "libmp3lame", "extension": ".mp3", "format": "mp3", "codec": "mp3"},
+    "aac": {"encoder": "aac", "extension": ".m4a", "format": "ipod", "codec": "aac"},
+    "opus": {"encoder": "libopus", "extension": ".opus", "format": "ogg", "codec": "opus"},
+    "vorbis": {"encoder": "libvorbis", "extension": ".ogg", "format": "ogg", "codec": "vorbis"},
+    "flac": {"encoder": "flac", "extension": ".flac", "format": "flac", "codec": "flac"},
+}
+
+_convert_slots = None
+
+
+def target(codec=None):
+    """
+    Settings of the target format, or None when files are kept as they are.
+    """
+    codec = codec or target_codec
+    if codec == "original":
+        return None
+    if codec not in TARGETS:
+        raise ValueError(f"Unknown TARGET_CODEC {codec!r}; use one of "
+                         f"{', '.join(TARGETS)} or original")
+    return TARGETS[codec]
+
+
+def output_path(file_path, codec=None):
+    """
+    Path the transcoded file gets: the source's name with the target's extension.
+    """
+    settings = target(codec)
+    if settings is None:
+        return file_path
+    return os.path.splitext(file_path)[0] + settings["extension"]
+
+
+def needs_transcode(file_path, codec=None):
+    """
+    True if the file is not in the target format yet. Both the stream and
+    the extension must match (an .m4a may hold mp3).
+    """
+    settings = target(codec)
+    if settings is None:
+        return False
+    if not file_path.lower().endswith(settings["extension"]):
+        return True
+    try:
+        info = media_info(file_path)
+    except OSError:
+        info = {}
+    return info.get("codec") not in (None, settings["codec"])
+
+
+def _paths(file_path, output_dir, codec):
+    if output_dir is None:
+        output_dir = os.path.dirname(file_path)
+    out_file = os.path.join(output_dir, os.path.basename(output_path(file_path, codec)))
+    # Hidden temp name so the watcher ignores the half-written output.
+    tmp_file = os.path.join(output_dir, f".{os.path.basename(out_file)}.part")
+    return out_file, tmp_file
+
+
+def _ffmpeg_cmd(file_path, tmp_file, codec):
+    settings = target(codec)
+    try:
+        source_codec = media_info(file_path).get("codec")
+    except OSError:
+        source_codec = None
+    # ffmpeg decodes and encodes in a stream, so memory stays constant no
+    # matter how long the input is.
+    cmd = ["ffmpeg", "-v", "error", "-nostdin", "-y", "-i", file_path, "-vn"]
+    if source_codec == settings["codec"]:
+        # Right codec in the wrong container (e.g. raw .aac): remux only.
+        cmd += ["-codec:a", "copy"]
+    else:
+        cmd += ["-codec:a", settings["encoder"]]
+        if target_bitrate:
+            cmd += ["-b:a", target_bitrate]
+    return cmd + ["-f", settings["format"], tmp_file]
+
+
+def transcode(file_path, output_dir=None, codec=None, timeout=None):
+    """
+    Transcode a file to the target format.
+    Returns the path to the new file.
+    """
+    out_file, tmp_file = _paths(file_path, output_dir, codec)
+    logger.debug(f"Transcoding {file_path} -> {out_file}")
+    try:
+        subprocess.run(_ffmpeg_cmd(file_path, tmp_file, codec), check=True,
+                       timeout=timeout or convert_timeout)
+        os.replace(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return out_file
+
+
+async def transcode_async(file_path, output_dir=None, codec=None, timeout=None):
+    """
+    Transcode a file to the target format without blocking the event loop.
+
+    At most `convert_workers` ffmpeg processes run at once. The output is
+    written to a temp name and renamed into place only on success; on
+    timeout or cancellation ffmpeg is killed and the temp file removed.
+    """
+    global _convert_slots
+    if _convert_slots is None:
+        _convert_slots = asyncio.Semaphore(convert_workers)
+    timeout = timeout or convert_timeout
+    out_file, tmp_file = _paths(file_path, output_dir, codec)
+
+    async with _convert_slots:
+        logger.debug(f"Transcoding {file_path} -> {out_file}")
+        cmd = await asyncio.to_thread(_ffmpeg_cmd, file_path, tmp_file, codec)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(
+                    proc.returncode, "ffmpeg", stderr=stderr)
+            os.replace(tmp_file, out_file)
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+    return out_file
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import logger as logger
+
+log = logger.logger
+
+LEDGER_DB = os.getenv("UPLOAD_LEDGER_DB", os.path.join(
+    os.path.dirname(__file__), "..", "uploaded_files.db"))
+# Ledger format used before the SQLite ledger; migrated on first open.
+TRACKER_JSON = os.path.join(os.path.dirname(
+    __file__), "..", "uploaded_files.json")
+
+
+def file_hash(file_path, block_size=1024 * 1024):
+    """
+    SHA-256 of the whole file, as uploaded.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadLedger:
+    """
+    Durable record of completed uploads, keyed by content hash and remote
+    path. Every upload is its own committed SQLite transaction, so a crash
+    can lose at most the upload in flight, never the history.
+    """
+
+    def __init__(self, db_path=LEDGER_DB, legacy_json=TRACKER_JSON):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                content_hash TEXT NOT NULL,
+                remote_path TEXT NOT NULL,
+                basename TEXT NOT NULL,
+                size INTEGER,
+                mtime REAL,
+                uploaded_at REAL NOT NULL,
+                transfer_seconds REAL,
+                PRIMARY KEY (content_hash, remote_path)
+            )""")
+        columns = [row[1] for row in self._conn.execute(
+            "PRAGMA table_info(uploads)")]
+        if "transfer_seconds" not in columns:
+            self._conn.execute(
+                "ALTER TABLE uploads ADD COLUMN transfer_seconds REAL")
+        # Entries migrated from uploaded_files.json only know the basename.
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS legacy_uploads (
+                basename TEXT PRIMARY KEY
+            )""")
+        self._conn.commit()
+        if legacy_json and os.path.exists(legacy_json):
+            self.migrate_json(legacy_json)
+
+    def migrate_json(self, json_path):
+        """
+        Import an uploaded_files.json tracker and rename it out of the way.
+        """
+        try:
+            with open(json_path, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            log.error(f"Could not read upload tracker {json_path}: {e}")
+            return 0
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO legacy_uploads (basename) VALUES (?)",
+                [(name,) for name in data])
+            self._conn.commit()
+        os.replace(json_path, json_path + ".migrated")
+        log.info(
+            f"Migrated {len(data)} entries from {json_path} to the upload ledger")
+        return len(data)
+
+    def is_uploaded(self, content_hash, remote_path):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM uploads WHERE content_hash = ? AND remote_path = ?",
+                (content_hash, remote_path)).fetchone()
+        return row is not None
+
+    def hashes_at(self, remote_path):
+        """
+        Content hashes of every file uploaded to `remote_path`.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content_hash FROM uploads WHERE remote_path = ?", (remote_path,)).fetchall()
+        return {row[0] for row in rows}
+
+    def is_legacy_uploaded(self, basename):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM legacy_uploads WHERE basename = ?", (basename,)).fetchone()
+        return row is not None
+
+    def record(self, content_hash, remote_path, file_path, transfer_seconds=None):
+        st = os.stat(file_path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploads "
+                "(content_hash, remote_path, basename, size, mtime, uploaded_at, transfer_seconds) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (content_hash, remote_path, os.path.basename(file_path),
+                 st.st_size, st.st_mtime, time.time(), transfer_seconds))
+            self._conn.commit()
+
+
+upload_ledger = UploadLedger()
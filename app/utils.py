@@ -1,16 +1,32 @@
+import io
 import math
 import os
 import re
 import shutil
 import requests  # added import for downloading cover image
 import subprocess
+import wave
+import base64
+import mutagen
 from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3, TIT2, TPE1, APIC
-from pydub import AudioSegment
+from mutagen.id3 import ID3, TIT2, TPE1, APIC, COMM
+from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4, MP4Cover
+from mutagen.flac import FLAC, Picture
+from mutagen.oggvorbis import OggVorbis
+from mutagen.oggopus import OggOpus
+from mutagen.oggflac import OggFLAC
+from mutagen.wave import WAVE
 import logger as logger
+from media_info import media_duration
 
 log = logger.logger  # shared logger
 
+# Probe windows tried in priority order: seconds ("45s") or percent of the
+# track length ("50%").
+probe_windows = os.getenv("PROBE_WINDOWS", "45s,25%,50%,75%")
+PROBE_SAMPLE_RATE = 16000
+
 
 def try_int(s):
     try:
@@ -23,15 +39,15 @@ def alphanum_key(s):
     return [try_int(c) for c in re.split("([0-9]+)", s)]
 
 
-def update_mp3_metadata(file_path, track_data=None, title=None, artist=None, cover_path=None):
+def update_mp3_metadata(file_path, track_data=None, title=None, artist=None, cover_path=None, cover_data=None):
     # If track_data is provided, use its values as defaults
     if track_data:
         title = title or track_data.get("title")
         artist = artist or track_data.get("subtitle")
         cover_path = cover_path or track_data.get("images", {}).get("coverart")
     log.debug(f"Updating metadata for file: {file_path}")
-    cover_data = None
-    if cover_path:
+    # Pre-fetched cover bytes (see cover_art.py) skip the download below.
+    if cover_data is None and cover_path:
         if cover_path.startswith("http"):
             log.debug(f"Downloading cover from {cover_path}")
             try:
@@ -94,23 +110,208 @@ def update_mp3_metadata(file_path, track_data=None, title=None, artist=None, cov
     log.info(f"Metadata updated for {file_path}")
 
 
-def split_audio_file(input_file, output_folder, duration, skip_chunk, start_offset=0):
+def _cover_picture(cover_data):
+    picture = Picture()
+    picture.type = 3
+    picture.mime = "image/jpeg"
+    picture.desc = "Cover"
+    picture.data = cover_data
+    return picture
+
+
+def update_metadata(file_path, title=None, artist=None, cover_data=None, comment=None):
+    """
+    Write title, artist, cover and an optional comment in the file's own tag
+    format: ID3 for mp3 and WAV, Vorbis comments for FLAC and Ogg, atoms
+    for MP4. Returns False (and leaves the file alone) for containers that
+    cannot carry tags, such as raw AAC.
+    """
+    audio = mutagen.File(file_path)
+    if isinstance(audio, MP3):
+        update_mp3_metadata(file_path, title=title, artist=artist, cover_data=cover_data)
+        if comment:
+            tags = ID3(file_path)
+            tags.setall("COMM", [COMM(encoding=3, lang="eng", desc="", text=comment)])
+            tags.save(v2_version=3)
+        return True
+    if audio is None or not isinstance(audio, (MP4, FLAC, OggVorbis, OggOpus, OggFLAC, WAVE)):
+        log.warning(f"Cannot write tags to {file_path} ({type(audio).__name__}), leaving it untagged")
+        return False
+    if audio.tags is None:
+        audio.add_tags()
+    if isinstance(audio, MP4):
+        audio.tags["\xa9nam"] = [title]
+        audio.tags["\xa9ART"] = [artist]
+        if comment:
+            audio.tags["\xa9cmt"] = [comment]
+        if cover_data:
+            audio.tags["covr"] = [MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG)]
+    elif isinstance(audio, WAVE):
+        # WAV keeps an ID3 tag in a RIFF chunk.
+        audio.tags.setall("TIT2", [TIT2(encoding=3, text=title)])
+        audio.tags.setall("TPE1", [TPE1(encoding=3, text=artist)])
+        if comment:
+            audio.tags.setall("COMM", [COMM(encoding=3, lang="eng", desc="", text=comment)])
+        if cover_data:
+            audio.tags.setall("APIC", [APIC(encoding=3, mime="image/jpeg", type=3,
+                                            desc="Cover", data=cover_data)])
+    else:
+        audio.tags["title"] = [title]
+        audio.tags["artist"] = [artist]
+        if comment:
+            audio.tags["comment"] = [comment]
+        if cover_data:
+            picture = _cover_picture(cover_data)
+            if isinstance(audio, FLAC):
+                audio.clear_pictures()
+                audio.add_picture(picture)
+            else:
+                # Ogg streams carry the FLAC picture block base64 encoded.
+                audio.tags["metadata_block_picture"] = [
+                    base64.b64encode(picture.write()).decode("ascii")]
+    audio.save()
+    log.info(f"Metadata updated for {file_path}")
+    return True
+
+
+def parse_probe_windows(spec):
+    """
+    Parse a comma separated window spec such as "45s,25%,50%,75%".
+    Returns a list of (value, unit) tuples in priority order.
+    """
+    windows = []
+    for item in spec.split(","):
+        item = item.strip().lower()
+        if not item:
+            continue
+        if item.endswith("%"):
+            windows.append((float(item[:-1]), "%"))
+        else:
+            windows.append((float(item.rstrip("s")), "s"))
+    return windows
+
+
+def resolve_probe_offsets(windows, total_sec, duration_sec):
     """
-    Splits an audio file using ffmpeg. 
-    Added start_offset (in milliseconds) to begin extraction after a given offset.
+    Turn window specs into start offsets (seconds) that fit inside the file.
+    Offsets are clamped so each window ends before the track does, and
+    duplicates after clamping are dropped. Priority order is preserved.
+    """
+    if total_sec is None:
+        # Without a duration only absolute offsets can be used.
+        offsets = [value for value, unit in windows if unit == "s"] or [0.0]
+        return list(dict.fromkeys(offsets))
+    latest = max(0.0, total_sec - duration_sec)
+    offsets = []
+    for value, unit in windows:
+        offset = total_sec * value / 100.0 if unit == "%" else value
+        offset = round(min(max(0.0, offset), latest), 2)
+        if offset not in offsets:
+            offsets.append(offset)
+    return offsets
+
+
+def _probe_offsets(input_file, duration_sec, windows=None):
+    windows = windows if windows is not None else parse_probe_windows(
+        probe_windows)
+    return resolve_probe_offsets(
+        windows, media_duration(input_file), duration_sec)
+
+
+def split_audio_file(input_file, output_folder, duration, windows=None, offsets=None):
+    """
+    Extract probe windows from an audio file with a single ffmpeg process.
+
+    Each window becomes its own seeked input mapped to chunk_<n>.mp3, so the
+    chunks are written in priority order (chunk_0 is tried first) without
+    spawning one ffmpeg per window. Explicit `offsets` (seconds) take
+    precedence over `windows`. Returns the list of chunk paths.
     """
-    # Convert ms to seconds for ffmpeg.
-    start_sec = start_offset / 1000.0
     duration_sec = duration / 1000.0
-    # Construct the output fragment file name (you may loop or generate multiple fragments).
-    output_file = f"{output_folder}/chunk_0.mp3"
-    ffmpeg_cmd = [
-        "ffmpeg",
-        "-ss", str(start_sec),           # start offset
-        "-i", input_file,
-        "-t", str(duration_sec),         # duration to extract
-        "-c", "copy",
-        output_file,
-        "-y"
-    ]
+    if offsets is None:
+        offsets = _probe_offsets(input_file, duration_sec, windows)
+    # mp3 windows are cut without re-encoding; other formats are encoded to
+    # mp3 so every chunk is something Shazam reads.
+    codec = ["-c", "copy"] if input_file.lower().endswith(".mp3") else ["-c:a", "libmp3lame"]
+
+    ffmpeg_cmd = ["ffmpeg", "-v", "error", "-y"]
+    for start_sec in offsets:
+        ffmpeg_cmd += ["-ss", str(start_sec), "-t", str(duration_sec),
+                       "-i", input_file]
+    output_files = []
+    for index in range(len(offsets)):
+        output_file = f"{output_folder}/chunk_{index}.mp3"
+        ffmpeg_cmd += ["-map", f"{index}:a:0", *codec, output_file]
+        output_files.append(output_file)
+    log.debug(
+        f"Extracting {len(offsets)} probe window(s) at {offsets} s from {input_file}")
     subprocess.run(ffmpeg_cmd, check=True)
+    return output_files
+
+
+def extract_probe_windows(input_file, duration, windows=None, offsets=None):
+    """
+    Extract probe windows straight into memory, without touching the disk.
+
+    A single ffmpeg process decodes every window to 16 kHz mono PCM (what
+    Shazam's signature uses anyway), pads/trims each to exactly `duration`
+    and writes them back to back to stdout. Returns a list of
+    (offset_sec, wav_bytes) in priority order. Explicit `offsets` take
+    precedence over `windows`, as in split_audio_file.
+    """
+    duration_sec = duration / 1000.0
+    if offsets is None:
+        offsets = _probe_offsets(input_file, duration_sec, windows)
+    window_samples = int(PROBE_SAMPLE_RATE * duration_sec)
+
+    ffmpeg_cmd = ["ffmpeg", "-v", "error", "-nostdin"]
+    for start_sec in offsets:
+        ffmpeg_cmd += ["-ss", str(start_sec), "-t", str(duration_sec),
+                       "-i", input_file]
+    filters = [
+        f"[{index}:a:0]aresample={PROBE_SAMPLE_RATE},"
+        f"aformat=sample_fmts=s16:channel_layouts=mono,"
+        f"apad=whole_len={window_samples},atrim=end_sample={window_samples}[w{index}]"
+        for index in range(len(offsets))
+    ]
+    inputs = "".join(f"[w{index}]" for index in range(len(offsets)))
+    filters.append(f"{inputs}concat=n={len(offsets)}:v=0:a=1[out]")
+    ffmpeg_cmd += ["-filter_complex", ";".join(filters),
+                   "-map", "[out]", "-f", "s16le", "pipe:1"]
+    log.debug(
+        f"Streaming {len(offsets)} probe window(s) at {offsets} s from {input_file}")
+    pcm = subprocess.run(ffmpeg_cmd, check=True,
+                         stdout=subprocess.PIPE).stdout
+
+    window_bytes = window_samples * 2
+    result = []
+    for index, start_sec in enumerate(offsets):
+        chunk = pcm[index * window_bytes:(index + 1) * window_bytes]
+        if not chunk:
+            break
+        result.append((start_sec, pcm_to_wav(chunk, PROBE_SAMPLE_RATE)))
+    return result
+
+
+def decode_mono_pcm(input_file, start_sec, duration_sec, sample_rate):
+    """
+    Decode part of a file to signed 16-bit mono PCM at `sample_rate`,
+    streamed from ffmpeg's stdout. Returns the raw bytes.
+    """
+    ffmpeg_cmd = ["ffmpeg", "-v", "error", "-nostdin",
+                  "-ss", str(max(0.0, start_sec)), "-t", str(duration_sec), "-i", input_file,
+                  "-vn", "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "pipe:1"]
+    return subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.PIPE).stdout
+
+
+def pcm_to_wav(pcm, sample_rate, channels=1):
+    """
+    Wrap raw signed 16-bit PCM in a WAV container.
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
@@ -0,0 +1,138 @@
+import asyncio
+import os
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+import logger as logger
+
+log = logger.logger
+
+# How long a file's size and mtime must stay unchanged before it is handed
+# to the pipeline, and how often it is re-checked while settling.
+stable_seconds = float(os.getenv("WATCH_STABLE_SECONDS", "3"))
+poll_seconds = float(os.getenv("WATCH_POLL_SECONDS", "1"))
+
+
+def file_key(path):
+    """
+    Key used to de-duplicate work on a file. Conversions write a sibling file
+    with the same stem (song.m4a -> song.mp3), so both share one key.
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class _EventHandler(FileSystemEventHandler):
+    """
+    Forward watchdog events (raised on the observer thread) to the event loop.
+    """
+
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def _forward(self, path):
+        self.watcher.loop.call_soon_threadsafe(self.watcher.submit, path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._forward(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._forward(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._forward(event.dest_path)
+
+
+class FileWatcher:
+    """
+    Watch a folder and put files on an asyncio queue once they stop changing.
+
+    Every path goes through a settle task that polls size/mtime until they
+    have been stable for `stable_seconds`, so half-copied uploads are never
+    processed. Paths that are settling, queued or being processed are ignored
+    until `done()` is called for them.
+    """
+
+    def __init__(self, path_to_dir, loop=None):
+        self.path_to_dir = path_to_dir
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        self.observer = None
+        self._busy = set()
+        self._tasks = set()
+
+    def start(self):
+        self.observer = Observer()
+        self.observer.schedule(_EventHandler(
+            self), self.path_to_dir, recursive=False)
+        self.observer.start()
+        log.info(f"Watching {self.path_to_dir} for new files")
+
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+        for task in self._tasks:
+            task.cancel()
+
+    def submit(self, path):
+        """
+        Start settling a path unless it is already known. Safe to call from
+        both watchdog events and the reconciliation scan.
+        """
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.path_to_dir):
+            return
+        if os.path.basename(path).startswith("."):
+            # Hidden files are temp outputs (ours or an uploader's).
+            return
+        key = file_key(path)
+        if key in self._busy:
+            return
+        self._busy.add(key)
+        task = self.loop.create_task(self._settle(path, key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def done(self, path):
+        """
+        Mark a path as finished so future events for it are picked up again.
+        """
+        self._busy.discard(file_key(path))
+
+    async def _settle(self, path, key):
+        if await wait_until_stable(path):
+            log.debug(f"File is stable, queueing: {path}")
+            await self.queue.put(path)
+        else:
+            self._busy.discard(key)
+
+
+async def wait_until_stable(path, stable_for=None, interval=None):
+    """
+    Wait until the file's size and mtime have not changed for `stable_for`
+    seconds. Returns False if the file disappears while waiting.
+    """
+    stable_for = stable_seconds if stable_for is None else stable_for
+    interval = poll_seconds if interval is None else interval
+    last = None
+    unchanged = 0.0
+    while True:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            log.debug(f"File vanished before it settled: {path}")
+            return False
+        current = (st.st_size, st.st_mtime_ns)
+        if current == last:
+            unchanged += interval
+            if unchanged >= stable_for:
+                return True
+        else:
+            if last is not None:
+                log.debug(f"File still being written: {path}")
+            last = current
+            unchanged = 0.0
+        await asyncio.sleep(interval)
@@ -0,0 +1,261 @@
+"""
+Offline end-to-end benchmark of the processing pipeline.
+
+Generates synthetic audio fixtures (mp3, m4a, aac, flac, wav, ogg, opus)
+with ffmpeg, replaces Shazam with FakeShazam and uploads to an in-process SFTP server, then runs the real
+processing.process_file() on every fixture. Prints per-stage latency
+percentiles, files/minute and peak RSS as JSON so runs can be compared.
+
+    python bench/benchmark.py --files 20 --durations 30,240,900 --workers 4
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "app")
+
+
+def generate_fixtures(folder, count, durations, formats):
+    """
+    Write `count` files named "Artist N - Title N.<ext>", cycling through
+    the given durations (seconds) and formats.
+    """
+    codecs = {"mp3": ["-codec:a", "libmp3lame", "-b:a", "192k"],
+              "m4a": ["-codec:a", "aac", "-b:a", "192k"],
+              "aac": ["-codec:a", "aac", "-b:a", "192k", "-f", "adts"],
+              "flac": ["-codec:a", "flac"],
+              "wav": ["-codec:a", "pcm_s16le"],
+              "ogg": ["-codec:a", "libvorbis"],
+              "opus": ["-codec:a", "libopus", "-b:a", "128k"]}
+    files = []
+    for index in range(count):
+        duration = durations[index % len(durations)]
+        ext = formats[index % len(formats)]
+        path = os.path.join(folder, f"Artist {index} - Title {index}.{ext}")
+        tone = f"sine=frequency={220 + index * 7}:duration={duration}:sample_rate=44100"
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", tone,
+                        "-ac", "2", *codecs[ext], path], check=True)
+        files.append(path)
+    return files
+
+
+class StageTimer:
+    """
+    Collects wall-clock durations per pipeline stage by wrapping module
+    attributes in place.
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, module, name, stage):
+        original = getattr(module, name)
+        if asyncio.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        else:
+            @functools.wraps(original)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        setattr(module, name, timed)
+
+    def summary(self):
+        return {stage: percentiles(values) for stage, values in sorted(self.samples.items())}
+
+
+def percentiles(values):
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+    return {"count": len(ordered), "p50_ms": pick(0.5), "p90_ms": pick(0.9),
+            "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 2),
+            "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2)}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux; children covers the ffmpeg processes.
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {"self": round(own, 1), "children": round(children, 1)}
+
+
+def configure_environment(workdir, sftp_port):
+    """
+    Point every store and the SFTP settings at the scratch directory. Must
+    run before the app modules are imported, since they read it at import.
+    """
+    os.environ.update({
+        "RECOGNITION_CACHE_DB": os.path.join(workdir, "recognition_cache.db"),
+        "CATALOG_DB": os.path.join(workdir, "songs.db"),
+        "UPLOAD_LEDGER_DB": os.path.join(workdir, "uploaded_files.db"),
+        "COVER_CACHE_DIR": os.path.join(workdir, "cover_cache"),
+        "JOB_STORE_DB": os.path.join(workdir, "jobs.db"),
+        "FINGERPRINT_DB": os.path.join(workdir, "fingerprints.db"),
+        "PROBE_ANALYSIS_DB": os.path.join(workdir, "probe_analysis.db"),
+        "MEDIA_INFO_DB": os.path.join(workdir, "media_info.db"),
+        "SFTP_USERNAME": "bench",
+        "SFTP_PASSWORD": "bench",
+        "SFTP_HOST": "127.0.0.1",
+        "SFTP_PORT": str(sftp_port),
+        "SFTP_REMOTE_DIR": "/upload",
+    })
+    os.environ.pop("SLACK_WEBHOOK_URL", None)
+
+
+async def run_pipeline(files, to_process, processed, workers, shazam, timer):
+    import processing
+    from fake_shazam import current_file
+
+    slots = asyncio.Semaphore(workers)
+    outcomes = {"processed": 0, "errors": 0}
+
+    async def one(path):
+        file = os.path.basename(path)
+        async with slots:
+            current_file.set(file)
+            start = time.perf_counter()
+            try:
+                await processing.process_file(file, to_process, processed, 30000, shazam)
+                outcomes["processed"] += 1
+            except Exception as e:
+                outcomes["errors"] += 1
+                logging.getLogger("music_watchdog").error(
+                    f"Benchmark: {file} failed: {e}")
+            finally:
+                timer.record("process_file", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(path) for path in files))
+    return time.perf_counter() - start, outcomes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=12)
+    parser.add_argument("--durations", default="30,180,600",
+                        help="fixture lengths in seconds, cycled")
+    parser.add_argument("--formats", default="mp3,m4a",
+                        help="fixture formats, cycled")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.3,
+                        help="fake Shazam latency in seconds")
+    parser.add_argument("--hit-rate", type=float, default=0.8)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--shazam-rate", type=float, default=20,
+                        help="throttle requests per second")
+    parser.add_argument("--probe-mode", choices=["stream", "files"], default="stream",
+                        help="PROBE_MODE for the run; 'files' exercises process_chunks")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="keep fixtures and stores here")
+    parser.add_argument("--output", help="write the JSON report to a file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="music-watchdog-bench-")
+    to_process = os.path.join(workdir, "to_process")
+    processed = os.path.join(workdir, "processed_songs")
+    remote = os.path.join(workdir, "remote")
+    fixtures = os.path.join(workdir, "fixtures")
+    for folder in (to_process, processed, remote, fixtures):
+        os.makedirs(folder, exist_ok=True)
+
+    sys.path.insert(0, BENCH_DIR)
+    from sftp_server import start_sftp_server
+    configure_environment(workdir, start_sftp_server(remote))
+    os.environ["PROBE_MODE"] = args.probe_mode
+
+    sys.path.insert(0, APP_DIR)
+    import logger
+    logger.logger.setLevel(logging.DEBUG if args.verbose else logging.CRITICAL)
+    import processing
+    import recognize
+    import sftp_upload
+    from throttle import ShazamThrottle, ThrottledShazam
+    from fake_shazam import FakeShazam
+
+    durations = [float(d) for d in args.durations.split(",")]
+    formats = [f.strip() for f in args.formats.split(",")]
+    start = time.perf_counter()
+    fixture_files = generate_fixtures(fixtures, args.files, durations, formats)
+    fixture_seconds = time.perf_counter() - start
+    files = []
+    for path in fixture_files:
+        target = os.path.join(to_process, os.path.basename(path))
+        shutil.copy(path, target)
+        files.append(target)
+
+    timer = StageTimer()
+    timer.wrap(processing, "transcode_matched", "conversion")
+    timer.wrap(processing, "extract_probe_windows", "split")
+    timer.wrap(processing, "split_audio_file", "split")
+    timer.wrap(processing, "select_probe_offsets", "probe_analysis")
+    timer.wrap(processing, "match_fingerprint", "fingerprint_lookup")
+    timer.wrap(processing, "index_fingerprint", "fingerprint_index")
+    timer.wrap(processing, "recognize_file", "recognition")
+    timer.wrap(processing, "process_chunks", "chunk_recognition")
+    timer.wrap(recognize, "update_metadata", "tagging")
+    timer.wrap(processing, "move_file", "move")
+    timer.wrap(sftp_upload, "upload_file_sftp", "sftp_upload")
+    fake = FakeShazam(latency=args.latency, hit_rate=args.hit_rate,
+                      error_rate=args.error_rate, seed=args.seed)
+    shazam = ThrottledShazam(fake, ShazamThrottle(rate=args.shazam_rate))
+    timer.wrap(shazam, "recognize", "shazam_call")
+
+    elapsed, outcomes = asyncio.run(run_pipeline(
+        files, to_process, processed, args.workers, shazam, timer))
+
+    unrecognized = os.path.join(to_process, "unrecognized")
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "config": vars(args) | {"workdir": workdir},
+        "files": len(files),
+        "fixture_generation_seconds": round(fixture_seconds, 2),
+        "wall_seconds": round(elapsed, 3),
+        "files_per_minute": round(len(files) / elapsed * 60, 2) if elapsed else None,
+        "outcomes": outcomes | {
+            "uploaded": len(os.listdir(os.path.join(remote, "upload")))
+            if os.path.isdir(os.path.join(remote, "upload")) else 0,
+            "unrecognized": len(os.listdir(unrecognized)) if os.path.isdir(unrecognized) else 0,
+            "shazam_calls": fake.calls,
+            "shazam_errors": fake.errors,
+        },
+        "stages": timer.summary(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
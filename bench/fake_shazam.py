@@ -0,0 +1,43 @@
+import asyncio
+import contextvars
+import os
+import random
+
+# Name of the file being processed, set by the benchmark around each
+# process_file() call so the fake can answer with the matching track.
+current_file = contextvars.ContextVar("current_file", default=None)
+
+
+class FakeShazam:
+    """
+    Stand-in for shazamio.Shazam with configurable latency, hit rate and
+    error injection. A hit returns a track whose artist/title come from the
+    "ARTIST - TITLE" name of the file being processed, so is_match accepts it.
+    """
+
+    def __init__(self, latency=0.3, jitter=0.1, hit_rate=0.8, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.hit_rate = hit_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+
+    async def recognize(self, data):
+        self.calls += 1
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            raise ConnectionError("injected Shazam error")
+        file_name = current_file.get()
+        if file_name is None or self.random.random() >= self.hit_rate:
+            return {"matches": []}
+        base = os.path.splitext(os.path.basename(file_name))[0]
+        artist, _, title = base.partition(" - ")
+        return {"matches": [{}], "track": {
+            "key": str(abs(hash(base))),
+            "title": title,
+            "subtitle": artist,
+            "images": {},
+        }}
@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# The app modules open their SQLite stores on import; keep them out of the tree.
+_state = tempfile.mkdtemp(prefix="music-watchdog-tests-")
+for name, file_name in [("JOB_STORE_DB", "jobs.db"), ("RECOGNITION_CACHE_DB", "recognition_cache.db"),
+                        ("CATALOG_DB", "songs.db"), ("UPLOAD_LEDGER_DB", "uploaded_files.db"),
+                        ("FINGERPRINT_DB", "fingerprints.db"), ("SCAN_MANIFEST_DB", "scan_manifest.db"),
+                        ("MEDIA_INFO_DB", "media_info.db"), ("PROBE_ANALYSIS_DB", "probe_analysis.db")]:
+    os.environ.setdefault(name, os.path.join(_state, file_name))
+os.environ.setdefault("COVER_CACHE_DIR", os.path.join(_state, "cover_cache"))
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
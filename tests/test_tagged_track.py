@@ -0,0 +1,38 @@
+import asyncio
+import shutil
+import subprocess
+import pytest
+from mutagen.easyid3 import EasyID3
+
+import processing
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+
+
+def tagged_mp3(path, artist, title):
+    subprocess.run(["ffmpeg", "-v", "error", "-nostdin", "-y", "-f", "lavfi",
+                    "-i", "sine=frequency=440:duration=1", "-codec:a", "libmp3lame", str(path)],
+                   check=True)
+    tags = EasyID3()
+    tags["artist"] = artist
+    tags["title"] = title
+    tags.save(str(path))
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def trust_tags(monkeypatch):
+    monkeypatch.setattr(processing, "trust_existing_tags", True)
+
+
+def test_tags_that_do_not_match_the_name_are_rejected(tmp_path):
+    path = tagged_mp3(tmp_path / "random_upload_123.mp3", "Unknown Artist", "Track 01")
+    info = {"tags": {"artist": "Unknown Artist", "title": "Track 01"}}
+    assert asyncio.run(processing.tagged_track(path, info)) is None
+
+
+def test_tags_that_match_the_name_are_accepted(tmp_path):
+    path = tagged_mp3(tmp_path / "New Order - Blue Monday.mp3", "New Order", "Blue Monday")
+    info = {"tags": {"artist": "New Order", "title": "Blue Monday"}}
+    track = asyncio.run(processing.tagged_track(path, info))
+    assert track == {"title": "Blue Monday", "subtitle": "New Order", "source": "tags"}